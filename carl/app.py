@@ -3,6 +3,7 @@ import logging
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 from carl.audit import audit_log_init, audit_entry
+from carl.modules.fhirclient import FhirClient
 from carl.views import base_blueprint
 
 
@@ -15,6 +16,7 @@ def create_app(testing=False, cli=False):
     register_blueprints(app)
     configure_logging(app)
     configure_proxy(app)
+    configure_fhir_client(app)
 
     return app
 
@@ -50,3 +52,8 @@ def configure_proxy(app):
             # trust X-Forwarded-Port
             x_port=1,
         )
+
+
+def configure_fhir_client(app):
+    """Attach the pooled FHIR client shared by all requests from this app"""
+    app.extensions["fhir_client"] = FhirClient.from_config(app.config)
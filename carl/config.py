@@ -15,3 +15,59 @@ LOGSERVER_URL = os.getenv("LOGSERVER_URL")
 
 # NB log level hardcoded at INFO for logserver
 LOG_LEVEL = os.environ.get("LOG_LEVEL", "DEBUG").upper()
+
+# Seconds a cached ValueSet expansion is trusted before its version is
+# re-checked against FHIR_SERVER_URL; 0 (default) never expires
+VALUESET_CACHE_TTL = int(os.getenv("VALUESET_CACHE_TTL", 0))
+
+# Number of patients processed concurrently by the `classify` and
+# `declassify` commands; each worker holds at most one FHIR request in flight
+CLASSIFY_WORKERS = int(os.getenv("CLASSIFY_WORKERS", 1))
+
+# Shared FHIR client; connection pool holds at least CLASSIFY_WORKERS
+# connections, idempotent requests retried with exponential backoff
+FHIR_POOL_SIZE = int(os.getenv("FHIR_POOL_SIZE", 10))
+FHIR_RETRIES = int(os.getenv("FHIR_RETRIES", 3))
+FHIR_RETRY_BACKOFF = float(os.getenv("FHIR_RETRY_BACKOFF", 0.5))
+FHIR_TIMEOUT = int(os.getenv("FHIR_TIMEOUT", 30))
+
+# Patients per page when prefetching clinical resources via `_revinclude`;
+# pages with at least PREFETCH_INCLUDE_LIMIT included resources are assumed
+# truncated (matches HAPI default `maximumIncludesToLoadPerPage`)
+PREFETCH_PAGE_SIZE = int(os.getenv("PREFETCH_PAGE_SIZE", 50))
+PREFETCH_INCLUDE_LIMIT = int(os.getenv("PREFETCH_INCLUDE_LIMIT", 1000))
+
+# How `patient_has` filters a patient's resources on codings: "local" fetches
+# all and intersects in memory, "tokens" searches on chunks of
+# TOKEN_LIST_CHUNK_SIZE `system|code` tokens, "valueset" searches `code:in`
+PATIENT_HAS_FILTER = os.getenv("PATIENT_HAS_FILTER", "local")
+TOKEN_LIST_CHUNK_SIZE = int(os.getenv("TOKEN_LIST_CHUNK_SIZE", 40))
+
+# Parse large searches (i.e. spooled Patient ids, marker Conditions) a Bundle
+# `entry` at a time as the page downloads, rather than each page whole
+STREAM_BUNDLES = os.getenv("STREAM_BUNDLES", "").lower() in ("1", "true", "yes")
+
+# Order classification rules try the branches of `AnyOf` criteria: "declared",
+# or "adaptive" to try those cheapest per match (as learned over a run) first
+RULE_ORDER = os.getenv("RULE_ORDER", "declared")
+
+# Resource writes per batch Bundle, when writes are batched
+BATCH_WRITE_SIZE = int(os.getenv("BATCH_WRITE_SIZE", 100))
+
+# File persisting `classify` high-water marks; when set, `classify` only
+# reprocesses patients with clinical resources updated since its last run
+CLASSIFY_WATERMARK_FILE = os.getenv("CLASSIFY_WATERMARK_FILE")
+
+# Checkpoint file of patients completed by `classify` and `declassify`, from
+# which an interrupted run may `--resume`; removed once a run completes
+CLASSIFY_CHECKPOINT_FILE = os.getenv("CLASSIFY_CHECKPOINT_FILE")
+
+# Asynchronous classification, i.e. on Subscription notifications: number of
+# patients processed concurrently, and seconds to wait for further requests
+# for the same patient before classifying, coalescing bursts of updates
+CLASSIFY_QUEUE_WORKERS = int(os.getenv("CLASSIFY_QUEUE_WORKERS", 2))
+CLASSIFY_DEBOUNCE_SECONDS = float(os.getenv("CLASSIFY_DEBOUNCE_SECONDS", 5))
+
+# Bearer token FHIR Subscription notifications must present, configured as
+# the Subscription `channel.header`; when unset, notifications are accepted
+SUBSCRIPTION_TOKEN = os.getenv("SUBSCRIPTION_TOKEN")
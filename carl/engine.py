@@ -0,0 +1,336 @@
+"""Engine to run classification functions over many patients
+
+Patient classification is bound by FHIR round trips rather than CPU, so
+patients may be processed concurrently by a pool of worker threads.
+"""
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from flask import current_app
+from heapq import heappop, heappush
+from itertools import count
+from threading import Condition, Thread
+from time import monotonic
+from uuid import uuid4
+from zlib import crc32
+
+from carl.modules.patient import PatientContext
+
+
+def process_patient(patient_id, process_functions, context=None):
+    """Call each of the process functions in order on given patient
+
+    Process functions share a single `PatientContext`, so each search for
+    the patient's resources round-trips at most once.
+
+    :returns: results dict, merged from each process function's results
+    """
+    context = context or PatientContext(patient_id)
+    results = context.results
+    for process_function in process_functions:
+        results.update(process_function(patient_id, context=context))
+    return results
+
+
+def matched(results):
+    """Returns True if any process function tagged the patient"""
+    # success is recorded in a key with the <condition.code>_matched pattern
+    return any(key.endswith("matched") for key in results.keys())
+
+
+def in_shard(patient_id, shard):
+    """True if patient falls in given shard, an (index, count) pair
+
+    Patients are partitioned by a stable hash of the id, so every process
+    given the same count agrees on each patient's shard.
+    """
+    index, count = shard
+    return crc32(str(patient_id).encode()) % count == index
+
+
+def shard_patients(patients, shard):
+    """Generate given patients falling in shard, i.e. (0, 4) for the first of four
+
+    :param patients: iterable of patient ids, or `PatientContext`s
+    """
+    for patient in patients:
+        if in_shard(getattr(patient, "patient_id", patient), shard):
+            yield patient
+
+
+def _isolated(app, patient, process_functions, writer=None, markers=None):
+    """Process single patient, capturing rather than raising any error"""
+    if isinstance(patient, PatientContext):
+        context = patient
+        context.writer = context.writer or writer
+        context.markers = context.markers or markers
+    else:
+        context = PatientContext(patient, writer=writer, markers=markers)
+    patient_id = context.patient_id
+    with app.app_context():
+        try:
+            results = process_patient(patient_id, process_functions, context)
+            return patient_id, results, None
+        except Exception as error:
+            current_app.logger.exception(f"failed to process patient {patient_id}")
+            return patient_id, None, error
+
+
+def run_patients(patients, process_functions, workers=1, writer=None, markers=None):
+    """Generate (patient_id, results, error) for each patient as it completes
+
+    A failure processing any single patient is logged and reported via the
+    `error` value, leaving remaining patients unaffected.
+
+    Given a `writer`, writes are queued rather than sent as each patient is
+    processed; outcomes of queued writes are added to the (already generated)
+    results as the writer flushes.  Callers must `flush()` the writer once
+    exhausted.
+
+    :param patients: iterable of Patient ids, or of `PatientContext`s
+      (i.e. preloaded with the patient's resources) to process
+    :param process_functions: ordered list of functions to call on each patient
+    :param workers: number of patients to process concurrently; also bounds
+      the number of requests in flight toward the FHIR store
+    :param writer: optional `carl.modules.batch.BatchWriter` given to each
+      patient's context
+    :param markers: optional `carl.modules.condition.MarkerIndex` of existing
+      marker Conditions, given to each patient's context
+    """
+    app = current_app._get_current_object()
+    if workers <= 1:
+        for patient in patients:
+            yield _isolated(app, patient, process_functions, writer, markers)
+        return
+
+    # Bound the number of queued patients, so they are pulled from the given
+    # iterable only as workers become available
+    max_pending = workers * 2
+    with ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix="carl-worker"
+    ) as executor:
+        pending = set()
+        for patient in patients:
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            pending.add(
+                executor.submit(
+                    _isolated, app, patient, process_functions, writer, markers
+                )
+            )
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+class Job(object):
+    """Asynchronous classification of a single patient, shared by coalesced requests"""
+
+    def __init__(self, patient_id):
+        self.id = uuid4().hex
+        self.patient_id = patient_id
+        # one of "queued", "running", "done" or "failed"
+        self.status = "queued"
+        self.results = None
+        self.error = None
+        # monotonic time of first request
+        self.requested = monotonic()
+
+    def finished(self):
+        return self.status in ("done", "failed")
+
+    def as_json(self):
+        return {
+            "id": self.id,
+            "patient_id": self.patient_id,
+            "status": self.status,
+            "results": self.results,
+            "error": self.error,
+        }
+
+
+class ClassificationQueue(object):
+    """Debounced queue of patients to classify asynchronously, i.e. on trigger events
+
+    Requests for a patient already waiting are coalesced, sharing the waiting
+    `Job`; a patient is only processed once `debounce` seconds have passed
+    since its first waiting request, so a burst of updates (i.e. a lab feed)
+    triggers a single classification.  A request arriving while the patient
+    is being processed queues one more run, as it may reflect data the running
+    one missed.
+
+    Patients are processed by a pool of `workers` background threads,
+    started on first use (so as not to precede a forking server), within an
+    app context.  Failures are logged, as with `run_patients`, and recorded
+    in the job.  The most recent `history` finished jobs are retained for
+    lookup via `job()`.
+    """
+
+    def __init__(self, app, process_functions, workers=1, debounce=0, history=1000):
+        """
+        :param app: Flask app, providing context to worker threads
+        :param process_functions: ordered list of functions to call on each patient
+        :param workers: number of patients to process concurrently
+        :param debounce: seconds to wait for further requests for a patient
+        :param history: number of finished jobs retained
+        """
+        self.app = app
+        self.process_functions = process_functions
+        self.workers = workers
+        self.debounce = debounce
+        self.history = history
+        self._condition = Condition()
+        self._threads = []
+        # (due time, sequence, patient_id) per waiting patient
+        self._heap = []
+        self._sequence = count()
+        # patient_id -> `Job`, of waiting patients
+        self._waiting = {}
+        # patient_id -> `Job`, requested while the patient is being processed
+        self._rerun = {}
+        # patient_id -> `Job`, of patients being processed
+        self._running = {}
+        # job id -> `Job`, in order requested
+        self._jobs = OrderedDict()
+        self._counts = dict.fromkeys(
+            ("requested", "coalesced", "processed", "failed"), 0
+        )
+        self._lag_total = 0.0
+        self._lag_max = 0.0
+
+    def put(self, patient_id):
+        """Queue given patient for classification, unless already waiting
+
+        :returns: the patient's `Job`, shared with any coalesced requests
+        """
+        with self._condition:
+            self._start()
+            self._counts["requested"] += 1
+            job = self._waiting.get(patient_id) or self._rerun.get(patient_id)
+            if job:
+                self._counts["coalesced"] += 1
+                return job
+
+            job = Job(patient_id)
+            self._jobs[job.id] = job
+            if patient_id in self._running:
+                self._rerun[patient_id] = job
+            else:
+                self._schedule(job)
+            return job
+
+    def job(self, job_id):
+        """Return `Job` with given id, None if unknown or no longer retained"""
+        with self._condition:
+            return self._jobs.get(job_id)
+
+    def join(self):
+        """Block until all queued patients are processed"""
+        with self._condition:
+            while self._waiting or self._rerun or self._running:
+                self._condition.wait()
+
+    def depth(self):
+        """Number of patients waiting to be processed"""
+        with self._condition:
+            return len(self._waiting) + len(self._rerun)
+
+    def stats(self):
+        """Return queue depth, lag and counters, suitable for summary reports
+
+        Lag is the time from a patient's first waiting request till its
+        processing starts, including the debounce window.
+        """
+        now = monotonic()
+        with self._condition:
+            started = self._counts["processed"] + len(self._running)
+            waiting = [
+                job.requested
+                for jobs in (self._waiting, self._rerun)
+                for job in jobs.values()
+            ]
+            stats = {f"queue_{k}": v for k, v in self._counts.items()}
+            stats.update(
+                {
+                    "queue_depth": len(waiting),
+                    "queue_running": len(self._running),
+                    "queue_oldest_seconds": (
+                        round(now - min(waiting), 3) if waiting else 0
+                    ),
+                    "queue_mean_lag_seconds": (
+                        round(self._lag_total / started, 3) if started else 0
+                    ),
+                    "queue_max_lag_seconds": round(self._lag_max, 3),
+                }
+            )
+            return stats
+
+    def _schedule(self, job):
+        self._waiting[job.patient_id] = job
+        heappush(
+            self._heap,
+            (job.requested + self.debounce, next(self._sequence), job.patient_id),
+        )
+        self._condition.notify_all()
+
+    def _start(self):
+        while len(self._threads) < self.workers:
+            thread = Thread(
+                target=self._work, name=f"carl-queue-{len(self._threads)}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def _next(self):
+        """Block until a waiting patient is due, returning its `Job`"""
+        with self._condition:
+            while True:
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                due, _, patient_id = self._heap[0]
+                remaining = due - monotonic()
+                if remaining > 0:
+                    self._condition.wait(remaining)
+                    continue
+
+                heappop(self._heap)
+                job = self._waiting.pop(patient_id)
+                lag = monotonic() - job.requested
+                self._lag_total += lag
+                self._lag_max = max(self._lag_max, lag)
+                job.status = "running"
+                self._running[patient_id] = job
+                return job
+
+    def _finish(self, job, results, error):
+        with self._condition:
+            job.results = results
+            job.error = str(error) if error else None
+            job.status = "failed" if error else "done"
+            del self._running[job.patient_id]
+            self._counts["processed"] += 1
+            if error:
+                self._counts["failed"] += 1
+            if job.patient_id in self._rerun:
+                self._schedule(self._rerun.pop(job.patient_id))
+
+            # forget the oldest finished jobs beyond history
+            finished = [j.id for j in self._jobs.values() if j.finished()]
+            for job_id in finished[: max(0, len(finished) - self.history)]:
+                del self._jobs[job_id]
+            self._condition.notify_all()
+
+    def _work(self):
+        while True:
+            job = self._next()
+            results, error = None, None
+            try:
+                _, results, error = _isolated(
+                    self.app, job.patient_id, self.process_functions
+                )
+            finally:
+                self._finish(job, results, error)
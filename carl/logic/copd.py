@@ -2,11 +2,9 @@
 from flask import current_app
 
 from carl.modules.coding import Coding
-from carl.modules.codeableconcept import CodeableConcept
-from carl.modules.condition import Condition, mark_patient_with_condition
-from carl.modules.patient import Patient, patient_has
-from carl.modules.resource import delete_resource
-from carl.modules.valueset import valueset_codings
+from carl.modules.condition import unmark_patient_with_condition
+from carl.modules.patient import patient_has_any
+from carl.modules.rules import HasCoding, Rule, classify, enabled_rules
 
 # ValueSet for all known COPD Condition codings - should match "url" in:
 # ``carl.serialized.COPD_valueset.json``
@@ -35,79 +33,47 @@ CNICS_COPD_medication_coding = Coding(
 )
 
 
-def process_4_COPD_conditions(patient_id):
-    """Process given patient for COPD conditions
-
-    NB: generates side effects, namely a special Condition is persisted in the
-    configured FHIR store for patients found to have a qualifying COPD Condition
-    """
-    current_app.logger.debug(f"process {patient_id} for COPD Conditions")
-
-    # process for matching conditions in value set
-    condition_codings = valueset_codings(COPD_VALUESET_URI)
-    positive_codings = patient_has(
-        patient_id=patient_id,
-        resource_type="Condition",
-        resource_codings=condition_codings,
-    )
-    results = {
-        "patient_id": patient_id,
-        "COPD Condition codings found": len(positive_codings) > 0,
-    }
-    if not positive_codings:
-        return results
-
-    return mark_patient_with_condition(patient_id, CNICS_COPD_coding, results)
-
-
-def process_4_COPD_medications(patient_id):
-    """Process given patient for COPD medications
-
-    NB: generates side effects, namely a special Condition is persisted in the
-    configured FHIR store for patients found to have a qualifying COPD MedicationRequest
-    """
-    current_app.logger.debug(f"process {patient_id} for COPD Medications")
+# Patients with at least one Condition from the CNICS COPD codings value set
+COPD_CONDITION_RULE = Rule(
+    marker=CNICS_COPD_coding,
+    criteria=HasCoding("Condition", COPD_VALUESET_URI, label="COPD Condition codings"),
+)
 
-    # process for mediation requests in value set
-    medication_codings = valueset_codings(COPD_MEDICATION_VALUESET_URI)
-    positive_codings = patient_has(
-        patient_id=patient_id,
-        resource_type="MedicationRequest",
-        resource_codings=medication_codings,
-        code_attribute="medicationCodeableConcept",
-    )
-    results = {
-        "patient_id": patient_id,
-        "COPD MedicationRequest codings found": len(positive_codings) > 0,
-    }
-    if not positive_codings:
-        return results
+# Of those, patients with at least one MedicationRequest from the CNICS COPD
+# medication codings value set
+COPD_MEDICATION_RULE = Rule(
+    marker=CNICS_COPD_medication_coding,
+    criteria=HasCoding(
+        "MedicationRequest",
+        COPD_MEDICATION_VALUESET_URI,
+        label="COPD MedicationRequest codings",
+    ),
+    requires=COPD_CONDITION_RULE,
+)
 
-    return mark_patient_with_condition(
-        patient_id, CNICS_COPD_medication_coding, results
-    )
+COPD_RULES = enabled_rules.register(COPD_CONDITION_RULE, COPD_MEDICATION_RULE)
 
 
-def classify_for_COPD(patient_id):
-    """classify given patient for diabetes
+def classify_for_COPD(patient_id, context=None):
+    """classify given patient for COPD, per `COPD_RULES`
 
     NB: generates side effects, namely a special Conditions are persisted in the
-    configured FHIR store for patients found to have a COPD using
+    configured FHIR store (or retracted, when known to be stale) for patients
+    found to have a COPD using
     the following criteria (applied in order, looking only till any case evaluates false):
     - If patient has at least one Condition from the CNICS COPD codings value set,
     mark patient with the CNICS_COPD_coding Condition
     - If patient has at least one MedicationRequest from the CNICS COPD medication coding
     value set, mark patient with the CNICS_COPD_medication_coding Condition
+
+    :param context: optional `PatientContext` to share fetched resources with
+      other classifiers run on the same patient
     """
-    results = process_4_COPD_conditions(patient_id)
-    # We only consider COPD meds if the patient obtained the COPD condition
-    # success is recorded in a key with the <condition.code>_matched pattern
-    if any(key.endswith("matched") for key in results.keys()):
-        results.update(process_4_COPD_medications(patient_id))
-    return results
+    current_app.logger.debug(f"process {patient_id} for COPD")
+    return classify(patient_id, COPD_RULES, context)
 
 
-def remove_COPD_classification(patient_id):
+def remove_COPD_classification(patient_id, context=None):
     """declassify given patient, i.e. remove added COPD Conditions
 
     Function used to reset or declassify patients previously found to have COPD,
@@ -118,25 +84,23 @@ def remove_COPD_classification(patient_id):
     configured FHIR store for patients found to have previously gained said Conditions
     """
     current_app.logger.debug(f"declassify {patient_id} of COPD")
-    classified_COPD_codings = set([CNICS_COPD_coding, CNICS_COPD_medication_coding])
-    previously_classified = patient_has(
+    classified_COPD_codings = set(rule.marker for rule in COPD_RULES)
+    previously_classified = patient_has_any(
         patient_id=patient_id,
         resource_codings=classified_COPD_codings,
         resource_type="Condition",
+        context=context,
     )
     results = {
         "patient_id": patient_id,
-        "COPD classification found": len(previously_classified) > 0,
+        "COPD classification found": previously_classified,
     }
     if not previously_classified:
         return results
 
     # Blindly try to remove all, knowing only one may be present on a patient
     for coding in classified_COPD_codings:
-        condition = Condition()
-        condition.code = CodeableConcept(coding)
-        condition.subject = Patient(patient_id)
-        delete_resource(resource=condition)
+        unmark_patient_with_condition(patient_id, coding, results, context)
 
     results["COPD_matched"] = True
 
@@ -2,12 +2,17 @@
 from flask import current_app
 
 from carl.modules.coding import Coding
-from carl.modules.codeableconcept import CodeableConcept
-from carl.modules.condition import Condition, mark_patient_with_condition
-from carl.modules.observation import patient_observations
-from carl.modules.patient import Patient, patient_has
-from carl.modules.resource import delete_resource
-from carl.modules.valueset import valueset_codings
+from carl.modules.condition import unmark_patient_with_condition
+from carl.modules.patient import patient_has_any
+from carl.modules.rules import (
+    AllOf,
+    AnyOf,
+    HasCoding,
+    Rule,
+    ValueAtLeast,
+    classify,
+    enabled_rules,
+)
 
 # ValueSets for all known diabetes MedicationRequest codings - should match "url"s in:
 # ``carl.serialized.diabetes_related_medication_valueset.json``
@@ -43,107 +48,48 @@ CNICS_diabetes_coding = Coding(
 )
 
 
-def process_labs(patient_id):
-    threshold = 6.5
-    labs = patient_observations(
-        patient_id=patient_id, resource_coding=A1C_observation_coding
-    )
-    results = {
-        "patient_id": patient_id,
-        f"{A1C_observation_coding.code} count": len(labs),
-    }
-    for obs in labs:
-        if obs.value_above_threshold(threshold):
-            results["Hemoglobin-A1C-threshold_matched"] = True
-            break
-    return results
-
-
-def process_diagnoses(patient_id):
-    # process for conditions in value set
-    conditions = valueset_codings(DIABETES_CONDITIONS_VALUESET_URL)
-    positive_codings = patient_has(
-        patient_id=patient_id,
-        resource_type="Condition",
-        resource_codings=conditions,
-        code_attribute="code",
-    )
-    results = {
-        "patient_id": patient_id,
-        "Diabetes Condition codings found": len(positive_codings) > 0,
-    }
-    if not positive_codings:
-        return results
-    results["Diabetes-Conditions_matched"] = True
-    return results
-
+# Criteria applied in order, looking only till any case evaluates true
+DIABETES_RULE = Rule(
+    marker=CNICS_diabetes_coding,
+    criteria=AnyOf(
+        # 1) Observation Hemoglobin A1C with valueQuantity >= 6.5
+        ValueAtLeast(A1C_observation_coding, 6.5),
+        # 2) MedicationRequest for any diabetes-specific medication
+        HasCoding("MedicationRequest", DIABETES_SPECIFIC_MEDICATION_VALUESET_URI),
+        # 3) MedicationRequest for any diabetes-related medication AND Diagnosis
+        AllOf(
+            HasCoding("MedicationRequest", DIABETES_RELATED_MEDICATION_VALUESET_URI),
+            HasCoding(
+                "Condition",
+                DIABETES_CONDITIONS_VALUESET_URL,
+                label="Diabetes Condition codings",
+            ),
+        ),
+    ),
+)
 
-def has_medications(patient_id, medication_value_set):
-    med_codings = valueset_codings(medication_value_set)
-    positive_codings = patient_has(
-        patient_id=patient_id,
-        resource_type="MedicationRequest",
-        resource_codings=med_codings,
-        code_attribute="medicationCodeableConcept",
-    )
-    results = dict()
-    results[f"{medication_value_set.split('/')[-1]} count"] = len(positive_codings)
-    if len(positive_codings) > 0:
-        results[f"{medication_value_set.split('/')[-1]}_matched"] = True
-    return results
+DIABETES_RULES = enabled_rules.register(DIABETES_RULE)
 
 
-def classify_for_diabetes(patient_id):
-    """classify given patient for diabetes
+def classify_for_diabetes(patient_id, context=None):
+    """classify given patient for diabetes, per `DIABETES_RULES`
 
     NB: generates side effects, namely a special Condition is persisted in the
-    configured FHIR store for patients found to have a diabetes using
+    configured FHIR store (or retracted, when known to be stale) for patients
+    found to have a diabetes using
     the following criteria (applied in order, looking only till any case evaluates true):
     - 1) Observation Hemoglobin A1C with valueQuantity >= 6.5
     - 2) MedicationRequest for any diabetes-specific medication
     - 3) MedicationRequest for any diabetes-related medication AND Diagnosis for diabetes
-    """
-
-    def tag_with_condition(results):
-        return mark_patient_with_condition(patient_id, CNICS_diabetes_coding, results)
 
+    :param context: optional `PatientContext` to share fetched resources with
+      other classifiers run on the same patient
+    """
     current_app.logger.debug(f"process {patient_id} for diabetes Condition")
-
-    # Criteria #1
-    results = process_labs(patient_id)
-    if any(key.endswith("matched") for key in results.keys()):
-        return tag_with_condition(results)
-
-    # Criteria #2
-    results.update(
-        has_medications(patient_id, DIABETES_SPECIFIC_MEDICATION_VALUESET_URI)
-    )
-    if any(key.endswith("matched") for key in results.keys()):
-        return tag_with_condition(results)
-
-    # Criteria #3-a
-    related_results = has_medications(
-        patient_id, DIABETES_RELATED_MEDICATION_VALUESET_URI
-    )
-    if not any(key.endswith("matched") for key in related_results.keys()):
-        results.update(related_results)
-        return results
-
-    # Criteria #3-b
-    diagnoses_results = process_diagnoses(patient_id)
-    if not any(key.endswith("matched") for key in diagnoses_results.keys()):
-        results.update(related_results)
-        results.update(diagnoses_results)
-        return results
-
-    # still here implies related_medications and process_diagnosis both returned true,
-    # i.e. Criteria 3 is true
-    results.update(related_results)
-    results.update(diagnoses_results)
-    return tag_with_condition(results)
+    return classify(patient_id, DIABETES_RULES, context)
 
 
-def remove_diabetes_classification(patient_id):
+def remove_diabetes_classification(patient_id, context=None):
     """declassify given patient, i.e. remove added diabetes Conditions
 
     Function used to reset or declassify patients previously found to have diabetes,
@@ -154,25 +100,23 @@ def remove_diabetes_classification(patient_id):
     configured FHIR store for patients found to have previously gained said Conditions
     """
     current_app.logger.debug(f"declassify {patient_id} of diabetes")
-    classified_diabetes_codings = set([CNICS_diabetes_coding])
-    previously_classified = patient_has(
+    classified_diabetes_codings = set(rule.marker for rule in DIABETES_RULES)
+    previously_classified = patient_has_any(
         patient_id=patient_id,
         resource_codings=classified_diabetes_codings,
         resource_type="Condition",
+        context=context,
     )
     results = {
         "patient_id": patient_id,
-        "diabetes classification found": len(previously_classified) > 0,
+        "diabetes classification found": previously_classified,
     }
     if not previously_classified:
         return results
 
     # Blindly try to remove all, knowing only one may be present on a patient
     for coding in classified_diabetes_codings:
-        condition = Condition()
-        condition.code = CodeableConcept(coding)
-        condition.subject = Patient(patient_id)
-        delete_resource(resource=condition)
+        unmark_patient_with_condition(patient_id, coding, results, context)
 
     results["diabetes_matched"] = True
 
@@ -0,0 +1,149 @@
+"""Write-behind buffer, flushing resource writes as FHIR batch Bundles"""
+from flask import current_app, has_app_context
+import logging
+from requests.exceptions import RequestException
+from threading import Condition, Lock
+
+from carl.modules.fhirclient import fhir_client
+
+
+class BatchWriter(object):
+    """Collect conditional writes, flushing as `batch` Bundles of `batch_size`
+
+    Each write may name a `results` dict and key, updated with the
+    outcome (the Bundle entry `response`) once its batch is flushed.  A
+    failed batch request is logged, and recorded as the outcome of each of
+    its entries, rather than raised; writes are frequently flushed from
+    worker threads on behalf of other patients.  Ids of the patients whose
+    writes failed accumulate in `failed_patients`.
+
+    See also https://www.hl7.org/fhir/http.html#transaction
+    """
+
+    def __init__(self, batch_size=100, dry_run=False):
+        """
+        :param batch_size: number of writes per Bundle
+        :param dry_run: discard rather than send writes, i.e. for testing
+        """
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.requests = 0
+        self.writes = 0
+        self.failures = 0
+        self.failed_patients = set()
+        self._lock = Lock()
+        # notified as each batch taken from `_pending` is sent
+        self._sent = Condition(self._lock)
+        self._sending = 0
+        # (Bundle entry, results dict, results key, patient id) per pending write
+        self._pending = []
+
+    def upsert(self, resource, results=None, key=None, patient_id=None):
+        """Queue conditional update (PUT with search params) of given resource
+
+        :param patient_id: patient the write is made on behalf of, recorded
+          in `failed_patients` should the write fail
+        """
+        self._queue(
+            {
+                "resource": resource.as_fhir(),
+                "request": {"method": "PUT", "url": resource.search_url()},
+            },
+            results,
+            key,
+            patient_id,
+        )
+
+    def delete(self, resource, results=None, key=None, patient_id=None):
+        """Queue conditional delete (DELETE with search params) of given resource"""
+        self._queue(
+            {"request": {"method": "DELETE", "url": resource.search_url()}},
+            results,
+            key,
+            patient_id,
+        )
+
+    def _queue(self, entry, results, key, patient_id):
+        with self._lock:
+            self._pending.append((entry, results, key, patient_id))
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self._drain()
+
+    def flush(self):
+        """Send all pending writes, in Bundles of at most `batch_size` entries
+
+        Returns once batches other threads are sending are also done, so
+        `failed_patients` accounts for every write queued beforehand.
+        """
+        self._drain()
+        with self._lock:
+            while self._sending:
+                self._sent.wait()
+
+    def _drain(self):
+        """Send pending writes, until none are left to take"""
+        while True:
+            with self._lock:
+                if not self._pending:
+                    return
+                batch = self._pending[: self.batch_size]
+                del self._pending[: self.batch_size]
+                self._sending += 1
+            try:
+                self._send(batch)
+            finally:
+                with self._lock:
+                    self._sending -= 1
+                    self._sent.notify_all()
+
+    def _send(self, batch):
+        with self._lock:
+            self.writes += len(batch)
+        if self.dry_run:
+            return
+
+        bundle = {
+            "resourceType": "Bundle",
+            "type": "batch",
+            "entry": [entry for entry, _, _, _ in batch],
+        }
+        try:
+            response = fhir_client().post("", json=bundle)
+            response.raise_for_status()
+            outcomes = [entry.get("response") for entry in response.json()["entry"]]
+        except (RequestException, KeyError, ValueError) as error:
+            message = f"batch of {len(batch)} writes failed: {error}"
+            if has_app_context():
+                current_app.logger.error(message)
+            else:
+                logging.error(message)
+            outcomes = [{"status": "error", "outcome": str(error)}] * len(batch)
+
+        # batch-response entries correspond in order to those requested
+        failed = [
+            patient_id
+            for (_, _, _, patient_id), outcome in zip(batch, outcomes)
+            if not succeeded(outcome)
+        ]
+        with self._lock:
+            self.requests += 1
+            self.failures += len(failed)
+            self.failed_patients.update(p for p in failed if p is not None)
+
+        for (_, results, key, _), outcome in zip(batch, outcomes):
+            if results is not None:
+                results[key] = outcome
+
+    def stats(self):
+        """Return write counters, suitable for summary reports"""
+        return {
+            "batch_writes": self.writes,
+            "batch_requests": self.requests,
+            "batch_failures": self.failures,
+        }
+
+
+def succeeded(outcome):
+    """True if Bundle entry response reports a 2xx status, i.e. "201 Created" """
+    return bool(outcome) and str(outcome.get("status", "")).startswith("2")
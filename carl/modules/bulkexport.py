@@ -0,0 +1,118 @@
+"""FHIR Bulk Data `$export` ingest, for offline whole-population classification
+
+NDJSON output, whether downloaded from a FHIR server or read from a
+directory of files, is streamed a line at a time into per-patient indexes,
+i.e. `PatientContext`s preloaded with all the patient's exported resources.
+
+See also https://hl7.org/fhir/uv/bulkdata/export.html
+"""
+from flask import current_app, has_app_context
+import json
+import os
+import time
+
+from carl.modules.fhirclient import fhir_client
+from carl.modules.observation import ObservationValues
+from carl.modules.patient import PatientContext
+from carl.modules.prefetch import subject_id
+
+# Resource types required by the classification rules
+EXPORT_TYPES = ("Patient", "Condition", "MedicationRequest", "Observation")
+
+
+def kick_off_export(resource_types=EXPORT_TYPES):
+    """Request asynchronous Patient level `$export`, return status url"""
+    response = fhir_client().get(
+        "Patient/$export",
+        params={"_type": ",".join(resource_types)},
+        headers={"Accept": "application/fhir+json", "Prefer": "respond-async"},
+    )
+    response.raise_for_status()
+    if response.status_code != 202:
+        raise RuntimeError(f"$export not accepted: {response.status_code}")
+    return response.headers["Content-Location"]
+
+
+def poll_export(status_url, interval=5, timeout=6 * 60 * 60):
+    """Poll `$export` status url till complete, returning the manifest"""
+    deadline = time.monotonic() + timeout
+    while True:
+        response = fhir_client().get(status_url)
+        response.raise_for_status()
+        if response.status_code == 200:
+            return response.json()
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"$export incomplete after {timeout} seconds")
+
+        # honor server's suggested wait, if given in seconds
+        retry_after = response.headers.get("Retry-After", "")
+        time.sleep(int(retry_after) if retry_after.isdigit() else interval)
+
+
+def ndjson_lines(lines):
+    """Generate resources from iterable of NDJSON lines, skipping blanks"""
+    for line in lines:
+        if line.strip():
+            yield json.loads(line)
+
+
+def export_resources(manifest):
+    """Generate resources from each file listed in `$export` manifest"""
+    for output in manifest.get("output", []):
+        response = fhir_client().get(
+            output["url"], headers={"Accept": "application/fhir+ndjson"}, stream=True
+        )
+        response.raise_for_status()
+        yield from ndjson_lines(response.iter_lines())
+
+
+def directory_resources(directory):
+    """Generate resources from all `.ndjson` files found in given directory"""
+    for filename in sorted(os.listdir(directory)):
+        if not filename.lower().endswith(".ndjson"):
+            continue
+        with open(os.path.join(directory, filename)) as ndjson:
+            yield from ndjson_lines(ndjson)
+
+
+def index_by_patient(resources, resource_types=EXPORT_TYPES):
+    """Index resources into a `PatientContext` per exported Patient
+
+    Every context is preloaded with (possibly empty) lists of each given
+    resource type, so rules evaluate entirely in memory.  Resources with no
+    exported Patient as subject are dropped.  Observation values of the whole
+    population are shared by the contexts as `labs`.
+
+    :returns: dict of `PatientContext`s keyed by patient id
+    """
+    clinical_types = [t for t in resource_types if t != "Patient"]
+    patient_ids = set()
+    by_subject = {}
+    for resource in resources:
+        resource_type = resource["resourceType"]
+        if resource_type == "Patient":
+            patient_ids.add(resource["id"])
+            continue
+        if resource_type not in clinical_types:
+            continue
+        patient_resources = by_subject.setdefault(subject_id(resource), {})
+        patient_resources.setdefault(resource_type, []).append(resource)
+
+    contexts = {}
+    labs = ObservationValues() if "Observation" in clinical_types else None
+    for patient_id in patient_ids:
+        context = PatientContext(patient_id)
+        patient_resources = by_subject.pop(patient_id, {})
+        for resource_type in clinical_types:
+            context.preload(resource_type, patient_resources.get(resource_type, []))
+        if labs is not None:
+            labs.extend(patient_id, context.resources("Observation"))
+            context.labs = labs
+        contexts[patient_id] = context
+
+    dropped = sum(
+        len(typed) for resources in by_subject.values() for typed in resources.values()
+    )
+    if dropped and has_app_context():
+        current_app.logger.warning(f"{dropped} exported resources lack a Patient")
+    return contexts
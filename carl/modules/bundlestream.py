@@ -0,0 +1,126 @@
+"""Incremental parsing of search Bundles, an `entry` at a time
+
+Rather than materializing a whole page of search results, the response body
+is read a chunk at a time, and each `entry` parsed and handed out as soon as
+it is complete, overlapping processing with the download.  Only the entry
+being parsed and the remainder of the current chunk are held in memory.
+"""
+import codecs
+import json
+
+# Bytes read from the response body at a time
+READ_SIZE = 64 * 1024
+
+WHITESPACE = " \t\n\r"
+# may follow a value
+DELIMITERS = ",:]}"
+
+_decoder = json.JSONDecoder()
+
+
+class BundleStream(object):
+    """Iterate the `entry` items of a Bundle, given its body as chunks of bytes
+
+    Top level fields other than `entry`, i.e. `link` and `total`, are parsed
+    whole into `bundle`, available as read; HAPI sends them ahead of `entry`,
+    but all are available once iteration completes.
+    """
+
+    def __init__(self, chunks):
+        """:param chunks: iterable of bytes, i.e. `Response.iter_content()`"""
+        self.bundle = {}
+        self.entries = 0
+        self._chunks = iter(chunks)
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        """Append next chunk to buffer, dropping parsed text; False at end"""
+        if self._eof:
+            return False
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            self._eof = True
+            self._utf8.decode(b"", final=True)
+            return False
+        parsed = self._pos
+        self._buffer = self._buffer[parsed:] + self._utf8.decode(chunk)
+        self._pos = 0
+        return True
+
+    def _peek(self):
+        """Return next non-whitespace character, None at end"""
+        while True:
+            while (
+                self._pos < len(self._buffer) and self._buffer[self._pos] in WHITESPACE
+            ):
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                return None
+
+    def _expect(self, chars):
+        """Consume next non-whitespace character, one of `chars`"""
+        char = self._peek()
+        if char is None or char not in chars:
+            raise ValueError(
+                f"malformed Bundle: expected one of {chars!r}, not {char!r}"
+            )
+        self._pos += 1
+        return char
+
+    def _value(self):
+        """Parse next JSON value, reading further until complete"""
+        self._peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # a scalar (i.e. a number cut short at `6.`) may go on, unless
+            # followed by a delimiter
+            if not isinstance(value, (dict, list, str)):
+                following = end
+                while (
+                    following < len(self._buffer)
+                    and self._buffer[following] in WHITESPACE
+                ):
+                    following += 1
+                delimited = (
+                    following < len(self._buffer)
+                    and self._buffer[following] in DELIMITERS
+                )
+                if not delimited and self._fill():
+                    continue
+            self._pos = end
+            return value
+
+    def __iter__(self):
+        self._expect("{")
+        if self._peek() == "}":
+            return
+        while True:
+            key = self._value()
+            self._expect(":")
+            if key == "entry":
+                yield from self._entries()
+            else:
+                self.bundle[key] = self._value()
+            if self._expect(",}") == "}":
+                return
+
+    def _entries(self):
+        self._expect("[")
+        if self._peek() == "]":
+            self._pos += 1
+            return
+        while True:
+            yield self._value()
+            self.entries += 1
+            if self._expect(",]") == "]":
+                return
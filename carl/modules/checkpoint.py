@@ -0,0 +1,114 @@
+"""Checkpoints of batch runs, so an interrupted run may resume
+
+A checkpoint file holds a JSON header line describing the run, followed by
+the id of each patient completed, a line apiece, appended as the run
+progresses.  The count of ids is the run's position.
+"""
+import json
+import os
+import time
+
+# Completed ids are committed once this many are buffered, or as many seconds
+# have passed since the last commit; a crash only means redoing the buffered
+COMMIT_EVERY = 100
+COMMIT_SECONDS = 5
+
+
+class CheckpointMismatch(ValueError):
+    """Checkpoint file was written by a run with different parameters"""
+
+
+class Checkpoint(object):
+    """Append only record of the patients a run has completed
+
+    Completed ids are buffered until `commit`ted, allowing callers to only
+    commit once any writes queued on behalf of the patients are flushed.
+    Each commit syncs the file to storage, so callers commit only when `due`.
+    """
+
+    def __init__(self, path, header, resume=False):
+        """
+        :param path: checkpoint file path
+        :param header: dict describing the run, i.e. command and site; a
+          resumed run must match that of the checkpoint
+        :param resume: load ids completed by the previous run from `path`,
+          rather than starting over
+        """
+        self.path = path
+        self.header = header
+        self.completed = set()
+        self._buffer = []
+        self._committed_at = time.monotonic()
+        if resume and os.path.exists(path):
+            self._file = open(path, "r+")
+            self._load()
+        else:
+            self._file = open(path, "w")
+            self._file.write(json.dumps(header) + "\n")
+            self._file.flush()
+
+    def _load(self):
+        header = json.loads(self._file.readline() or "{}")
+        if header != self.header:
+            self._file.close()
+            raise CheckpointMismatch(
+                f"checkpoint {self.path} is of another run: {header}"
+            )
+        end = self._file.tell()
+        for line in iter(self._file.readline, ""):
+            # a partial last line implies an interrupted write; redo it
+            if not line.endswith("\n"):
+                break
+            self.completed.add(line.rstrip("\n"))
+            end = self._file.tell()
+        self._file.seek(end)
+        self._file.truncate()
+
+    @property
+    def position(self):
+        """Number of patients completed, including by resumed runs"""
+        return len(self.completed) + len(self._buffer)
+
+    def skip(self, patients):
+        """Generate given patients, omitting those already completed
+
+        :param patients: iterable of patient ids, or `PatientContext`s
+        """
+        for patient in patients:
+            if getattr(patient, "patient_id", patient) not in self.completed:
+                yield patient
+
+    def done(self, patient_id):
+        """Buffer given patient id as completed"""
+        self._buffer.append(patient_id)
+
+    def discard(self, patient_ids):
+        """Drop given ids from the buffer, i.e. patients whose writes failed"""
+        self._buffer = [p for p in self._buffer if p not in patient_ids]
+
+    def due(self):
+        """True once COMMIT_EVERY ids are buffered, or COMMIT_SECONDS passed"""
+        if not self._buffer:
+            return False
+        return (
+            len(self._buffer) >= COMMIT_EVERY
+            or time.monotonic() - self._committed_at >= COMMIT_SECONDS
+        )
+
+    def commit(self):
+        """Append buffered ids to the checkpoint file"""
+        self._committed_at = time.monotonic()
+        if not self._buffer:
+            return
+        self._file.write("".join(f"{patient_id}\n" for patient_id in self._buffer))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.completed.update(self._buffer)
+        self._buffer = []
+
+    def close(self, remove=False):
+        """Commit and close; `remove` the file once the run is complete"""
+        self.commit()
+        self._file.close()
+        if remove:
+            os.remove(self.path)
@@ -1,6 +1,15 @@
 """FHIR Coding module"""
+import re
+
 from carl.modules.resource import Resource
 
+# Characters requiring a backslash escape within search parameter values
+# See https://www.hl7.org/fhir/search.html#escaping
+SEARCH_VALUE_SPECIALS = re.compile(r"([\\,$|])")
+
+# Canonical instance of each (system, code) key, see `coding_key`
+_interned_keys = {}
+
 
 class Coding(Resource):
     """FHIR Coding - used for serializing and queries"""
@@ -22,6 +31,11 @@ class Coding(Resource):
     def system(self):
         return self._fields.get("system")
 
+    @property
+    def key(self):
+        """Interned (system, code) key, see `coding_key`"""
+        return coding_key(self.system, self.code)
+
     @staticmethod
     def unique_params():
         return tuple(["code", "system"])
@@ -55,4 +69,72 @@ class Coding(Resource):
 
     def __hash__(self):
         """Generate logically unique hash for set functionality"""
-        return hash(f"{self._fields.get('system')}|{self._fields.get('code')}")
+        return hash((self._fields.get("system"), self._fields.get("code")))
+
+
+def coding_key(system, code):
+    """Return the canonical (system, code) tuple for given coding
+
+    Keys stand in for `Coding`s when matching; tuples of strings hash and
+    compare without allocation or attribute lookups, and interning shares a
+    single instance of each key between all long lived sets, i.e. ValueSet
+    expansions.  Any equal tuple, such as one built from a resource's
+    coding, matches an interned key.
+    """
+    key = (system, code)
+    return _interned_keys.setdefault(key, key)
+
+
+def coding_keys(codings):
+    """Return frozenset of (system, code) keys for given `Coding`s or keys"""
+    if isinstance(codings, frozenset) and isinstance(next(iter(codings), ()), tuple):
+        return codings
+    return frozenset(
+        coding if isinstance(coding, tuple) else coding.key for coding in codings
+    )
+
+
+def escape_search_value(value):
+    """Escape FHIR search special characters, i.e. commas in a code"""
+    return SEARCH_VALUE_SPECIALS.sub(r"\\\1", value)
+
+
+def token_list_param(codings):
+    """Generate comma delimited `[system]|[code]` token search value for codings
+
+    :param codings: `Coding`s, or (system, code) keys
+    See also https://www.hl7.org/fhir/search.html#token
+    """
+    keys = (c if isinstance(c, tuple) else c.key for c in codings)
+    return ",".join(
+        "|".join((escape_search_value(system), escape_search_value(code)))
+        for system, code in keys
+    )
+
+
+def parse_token_list(value):
+    """Parse token search value into list of (system, code) tuples
+
+    Inverse of `token_list_param`; system is None when not given.
+    """
+    tokens = []
+    parts = [""]
+    escaped = False
+    for character in value:
+        if escaped:
+            parts[-1] += character
+            escaped = False
+        elif character == "\\":
+            escaped = True
+        elif character == "|" and len(parts) == 1:
+            parts.append("")
+        elif character == ",":
+            tokens.append(parts)
+            parts = [""]
+        else:
+            parts[-1] += character
+    tokens.append(parts)
+    return [
+        (parts[0], parts[1]) if len(parts) == 2 else (None, parts[0])
+        for parts in tokens
+    ]
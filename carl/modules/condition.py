@@ -1,10 +1,13 @@
 """FHIR Condition module"""
 from flask import current_app
+from threading import Lock
 
 from carl.modules.codeableconcept import CodeableConcept
+from carl.modules.paging import next_resource_entry
 from carl.modules.patient import Patient
+from carl.modules.prefetch import subject_id
 from carl.modules.reference import Reference
-from carl.modules.resource import Resource, persist_resource
+from carl.modules.resource import Resource, delete_resource, persist_resource
 
 
 class Condition(Resource):
@@ -37,13 +40,165 @@ class Condition(Resource):
         return tuple(["code", "subject"])
 
 
-def mark_patient_with_condition(patient_id, condition_coding, results):
+class MarkerIndex(object):
+    """Existing marker Conditions, i.e. as persisted by previous classify runs
+
+    Marker codes are `load`ed with one search per code, rather than a lookup
+    per patient, so writes can be skipped when the marker is already present
+    and unchanged.  Thread safe counters of the writes made and avoided are
+    reported via `stats()`.
+    """
+
+    FIELDS = ("created", "updated", "unchanged", "removed")
+
+    def __init__(self):
+        self._lock = Lock()
+        # marker code -> {patient_id: Condition resource}
+        self._markers = {}
+        self._counts = dict.fromkeys(self.FIELDS, 0)
+
+    def load(self, coding):
+        """Search all Conditions with given marker coding, indexing by subject"""
+        by_subject = {}
+        # only the fields compared by `unchanged` are needed
+        search_params = {
+            "code": coding.value_param(),
+            "_elements": "code,subject",
+            "_count": 512,
+        }
+        for entry in next_resource_entry("Condition", search_params=search_params):
+            resource = entry["resource"]
+            by_subject.setdefault(subject_id(resource), resource)
+        with self._lock:
+            self._markers[coding.code] = by_subject
+
+    def indexed(self, coding):
+        """True if existing markers with given coding were loaded"""
+        return coding.code in self._markers
+
+    def get(self, coding, patient_id):
+        """Return patient's existing marker Condition with given coding, if any"""
+        return self._markers.get(coding.code, {}).get(patient_id)
+
+    def record(self, field):
+        with self._lock:
+            self._counts[field] += 1
+
+    def stats(self):
+        """Return counters, suitable for summary reports"""
+        with self._lock:
+            return {f"marker_{k}": v for k, v in self._counts.items()}
+
+
+def existing_marker(patient_id, condition_coding, context=None):
+    """Look up patient's existing marker Condition, without a round trip
+
+    Consults the context `markers` index, else the context's Conditions
+    when all the patient's Conditions are loaded (i.e. prefetched).
+
+    :returns: (known, resource) - `known` is False when existence can't be
+      determined without a search; otherwise `resource` is the existing
+      Condition, or None if absent
+    """
+    if context is None:
+        return False, None
+    if context.markers and context.markers.indexed(condition_coding):
+        return True, context.markers.get(condition_coding, patient_id)
+    if context.loaded("Condition"):
+        for resource in context.resources("Condition"):
+            for coding in resource.get("code", {}).get("coding", []):
+                if (
+                    coding.get("system") == condition_coding.system
+                    and coding.get("code") == condition_coding.code
+                ):
+                    return True, resource
+        return True, None
+    return False, None
+
+
+def is_marker(resource, marker_codings):
+    """True if given resource is a Condition coded only with marker codings"""
+    if resource.get("resourceType") != "Condition":
+        return False
+    markers = {(coding.system, coding.code) for coding in marker_codings}
+    codings = resource.get("code", {}).get("coding", [])
+    return bool(codings) and all(
+        (coding.get("system"), coding.get("code")) in markers for coding in codings
+    )
+
+
+def unchanged(existing, condition):
+    """True if the existing resource holds all fields of given Condition"""
+    desired = condition.as_fhir()
+    return all(existing.get(field) == value for field, value in desired.items())
+
+
+def mark_patient_with_condition(patient_id, condition_coding, results, context=None):
+    """Persist Condition with given coding for patient, noting in results
+
+    :param context: optional `PatientContext`; if it carries a `writer`, the
+      write is queued, and its outcome added to the context results once
+      flushed.  The write is skipped when the context knows of an identical,
+      existing marker (see `existing_marker`).
+    """
     condition = Condition()
     condition.code = CodeableConcept(condition_coding)
     condition.subject = Patient(patient_id)
-    response = persist_resource(resource=condition)
     results[f"{condition_coding.code}_matched"] = True
-    results[f"{condition_coding.code}_condition"] = response
+    known, existing = existing_marker(patient_id, condition_coding, context)
+    if known and context.markers:
+        if not existing:
+            context.markers.record("created")
+        elif unchanged(existing, condition):
+            context.markers.record("unchanged")
+        else:
+            context.markers.record("updated")
+
+    if existing and unchanged(existing, condition):
+        results[f"{condition_coding.code}_condition"] = existing
+    elif context and context.writer:
+        context.writer.upsert(
+            condition,
+            results=context.results,
+            key=f"{condition_coding.code}_condition",
+            patient_id=patient_id,
+        )
+    else:
+        response = persist_resource(resource=condition)
+        results[f"{condition_coding.code}_condition"] = response
 
     current_app.logger.debug(results)
     return results
+
+
+def unmark_patient_with_condition(
+    patient_id, condition_coding, results, context=None, if_known=False
+):
+    """Delete Condition with given coding from patient, if present
+
+    :param context: optional `PatientContext`; if it carries a `writer`, the
+      delete is queued, and its outcome added to the context results once
+      flushed.  The delete is skipped when the context knows the patient
+      lacks the marker (see `existing_marker`).
+    :param if_known: only delete a marker the context knows to exist, never
+      sending a blind conditional delete, i.e. to retract stale markers
+    """
+    known, existing = existing_marker(patient_id, condition_coding, context)
+    if (known or if_known) and not existing:
+        return results
+    if known and context.markers:
+        context.markers.record("removed")
+
+    condition = Condition()
+    condition.code = CodeableConcept(condition_coding)
+    condition.subject = Patient(patient_id)
+    if context and context.writer:
+        context.writer.delete(
+            condition,
+            results=context.results,
+            key=f"{condition_coding.code}_removed",
+            patient_id=patient_id,
+        )
+    else:
+        delete_resource(resource=condition)
+    return results
@@ -0,0 +1,151 @@
+"""Shared HTTP client for all round trips to the configured FHIR store"""
+from collections import defaultdict
+from flask import current_app, has_app_context
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+from threading import Lock
+import timeit
+from urllib3.util.retry import Retry
+
+from carl import config
+
+# HAPI responds with these when overloaded or restarting - worth another try
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Idempotent methods, safe to retry; notably excludes POST
+RETRY_METHODS = frozenset(("DELETE", "GET", "HEAD", "OPTIONS", "PUT"))
+
+
+def retry_policy(retries, backoff_factor):
+    """Generate urllib3 Retry, tolerating the rename of `method_whitelist`"""
+    kwargs = dict(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUSES,
+        raise_on_status=False,
+        respect_retry_after_header=True,
+    )
+    try:
+        return Retry(allowed_methods=RETRY_METHODS, **kwargs)
+    except TypeError:
+        return Retry(method_whitelist=RETRY_METHODS, **kwargs)
+
+
+class FhirClient(object):
+    """Pooled, keep-alive HTTP client for the FHIR store
+
+    Wraps a single `requests.Session`, so connections are reused between
+    requests and threads.  Idempotent requests are retried with backoff on
+    throttling or server errors, and the time spent on each request is logged
+    and accumulated for reporting via `stats()`.
+    """
+
+    def __init__(
+        self, base_url, pool_size=10, retries=3, backoff_factor=0.5, timeout=30
+    ):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.session = requests.Session()
+        self.session.headers.update(
+            {"Accept-Encoding": "gzip, deflate", "Connection": "keep-alive"}
+        )
+        self.pool_size = 0
+        self.ensure_pool(pool_size)
+
+        self._lock = Lock()
+        self._counts = defaultdict(int)
+        self._seconds = defaultdict(float)
+
+    @classmethod
+    def from_config(cls, settings):
+        """Instantiate from given mapping of configuration settings"""
+        return cls(
+            base_url=settings["FHIR_SERVER_URL"],
+            pool_size=max(settings["CLASSIFY_WORKERS"], settings["FHIR_POOL_SIZE"]),
+            retries=settings["FHIR_RETRIES"],
+            backoff_factor=settings["FHIR_RETRY_BACKOFF"],
+            timeout=settings["FHIR_TIMEOUT"],
+        )
+
+    def ensure_pool(self, size):
+        """Grow the connection pool to hold at least `size` connections"""
+        if size <= self.pool_size:
+            return
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=size,
+            max_retries=retry_policy(self.retries, self.backoff_factor),
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.pool_size = size
+
+    def url(self, path):
+        """Return absolute url; `path` is relative to base_url unless absolute"""
+        if path.startswith(("http://", "https://")):
+            return path
+        return f"{self.base_url}{path}"
+
+    def request(self, method, path, **kwargs):
+        """Issue request, returning the `requests.Response`
+
+        NB - like `requests`, does not raise on error status; call
+        `raise_for_status()` on the response as needed.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        start = timeit.default_timer()
+        response = self.session.request(method, self.url(path), **kwargs)
+        elapsed = timeit.default_timer() - start
+        with self._lock:
+            self._counts[method] += 1
+            self._seconds[method] += elapsed
+
+        message = f"HAPI {method}: {response.url} ({elapsed:.3f}s)"
+        if has_app_context():
+            current_app.logger.debug(message)
+        else:
+            logging.debug(message)
+        return response
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request("PUT", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request("DELETE", path, **kwargs)
+
+    def stats(self):
+        """Return request counts and cumulative seconds, suitable for summary reports"""
+        with self._lock:
+            return {
+                "fhir_requests": sum(self._counts.values()),
+                "fhir_request_seconds": round(sum(self._seconds.values()), 4),
+                "fhir_requests_by_method": dict(self._counts),
+            }
+
+
+_default_client = None
+_default_lock = Lock()
+
+
+def fhir_client():
+    """Return the FHIR client owned by the current app
+
+    Outside of an application context, falls back to a module level client
+    configured directly from `carl.config`.
+    """
+    global _default_client
+    if has_app_context() and "fhir_client" in current_app.extensions:
+        return current_app.extensions["fhir_client"]
+
+    with _default_lock:
+        if _default_client is None:
+            _default_client = FhirClient.from_config(vars(config))
+        return _default_client
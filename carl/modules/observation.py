@@ -1,6 +1,11 @@
 """FHIR Observation module"""
+from array import array
+from collections import Counter
+from threading import Lock
+
 from carl.modules.codeableconcept import CodeableConcept
-from carl.modules.paging import next_resource_bundle
+from carl.modules.coding import coding_key
+from carl.modules.patient import PatientContext
 from carl.modules.reference import Reference
 from carl.modules.resource import Resource
 from carl.modules.valuequantity import ValueQuantity
@@ -61,7 +66,8 @@ class Observation(Resource):
         """Deserialize from json (FHIR) data"""
         instance = cls()
         instance.code = CodeableConcept.from_fhir(data["code"])
-        instance.subject = Reference.from_fhir(data["subject"])
+        if "subject" in data:
+            instance.subject = Reference.from_fhir(data["subject"])
         if "valueQuantity" in data:
             instance.valuequantity = ValueQuantity.from_fhir(data["valueQuantity"])
         if "valueInteger" in data:
@@ -73,18 +79,109 @@ class Observation(Resource):
         return tuple(["code", "subject"])
 
 
-def patient_observations(patient_id, resource_coding):
-    """Return list of Observations for given patient, with given coding"""
-    patient_obs = list()
-    for bundle in next_resource_bundle(
-        resource_type="Observation",
-        search_params={
-            "subject": patient_id,
-            "code": f"{resource_coding.system}|{resource_coding.code}",
-        },
-    ):
-        for entry in bundle.get("entry", []):
-            obs = Observation.from_fhir(entry["resource"])
-            patient_obs.append(obs)
-
-    return patient_obs
+def patient_observations(patient_id, resource_coding, context=None):
+    """Return list of Observations for given patient, with given coding
+
+    :param context: optional `PatientContext` to share fetched resources
+      between calls for the same patient
+    """
+    context = context or PatientContext(patient_id)
+    return [
+        Observation.from_fhir(resource)
+        for resource in context.resources(
+            "Observation", {"code": resource_coding.value_param()}
+        )
+    ]
+
+
+def observation_value(resource):
+    """Return numeric value of Observation (JSON) data, None if without one"""
+    if "valueQuantity" in resource:
+        value = resource["valueQuantity"].get("value")
+    else:
+        value = resource.get("valueInteger")
+    return None if value is None else float(value)
+
+
+class ObservationValues(object):
+    """Numeric Observation values of many patients, held as parallel arrays
+
+    A row per coding of each Observation holds indices of the subject and
+    coding, and the value (NaN if none).  Evaluating a threshold over a page
+    or population of patients is then a single pass over compact arrays,
+    rather than deserializing `Observation`s a patient at a time.  Results
+    are kept until further values are added.
+    """
+
+    def __init__(self):
+        # index -> patient id, and the reverse
+        self.subjects = []
+        self._subject_index = {}
+        # (system, code) key -> index
+        self._coding_index = {}
+        self._subject = array("l")
+        self._coding = array("l")
+        self._value = array("d")
+        self._lock = Lock()
+        self._memo = {}
+
+    def __len__(self):
+        return len(self._value)
+
+    def extend(self, patient_id, resources):
+        """Add values of given patient's Observations (JSON)"""
+        with self._lock:
+            subject = self._subject_index.setdefault(patient_id, len(self.subjects))
+            if subject == len(self.subjects):
+                self.subjects.append(patient_id)
+            for resource in resources:
+                value = observation_value(resource)
+                value = float("nan") if value is None else value
+                keys = {
+                    coding_key(coding.get("system"), coding.get("code"))
+                    for coding in resource.get("code", {}).get("coding", [])
+                }
+                for key in keys:
+                    coding = self._coding_index.setdefault(key, len(self._coding_index))
+                    self._subject.append(subject)
+                    self._coding.append(coding)
+                    self._value.append(value)
+            self._memo.clear()
+
+    def _rows(self, key):
+        """Generate (subject index, value) of rows with given coding key"""
+        coding = self._coding_index.get(key)
+        if coding is None:
+            return
+        for subject, row_coding, value in zip(self._subject, self._coding, self._value):
+            if row_coding == coding:
+                yield subject, value
+
+    def at_least(self, key, threshold):
+        """Return frozenset of patient ids with a value at least threshold
+
+        :param key: (system, code) key of the Observation coding
+        """
+        with self._lock:
+            memo_key = ("at_least", key, float(threshold))
+            if memo_key not in self._memo:
+                threshold = float(threshold)
+                self._memo[memo_key] = frozenset(
+                    self.subjects[subject]
+                    for subject, value in self._rows(key)
+                    if value >= threshold
+                )
+            return self._memo[memo_key]
+
+    def counts(self, key):
+        """Return dict of Observation count by patient id, for given coding key"""
+        with self._lock:
+            memo_key = ("counts", key)
+            if memo_key not in self._memo:
+                self._memo[memo_key] = {
+                    self.subjects[subject]: count
+                    for subject, count in Counter(
+                        subject for subject, _ in self._rows(key)
+                    ).items()
+                }
+            return self._memo[memo_key]
@@ -1,9 +1,9 @@
 """Module to assist in paging through HAPI search bundles"""
-from flask import current_app, has_app_context
 import jmespath
-import requests
 
-from carl.config import FHIR_SERVER_URL
+from carl.config import STREAM_BUNDLES
+from carl.modules.bundlestream import READ_SIZE, BundleStream
+from carl.modules.fhirclient import fhir_client
 from carl.modules.resource import Resource
 
 
@@ -16,23 +16,26 @@ def next_page_link_from_bundle(bundle):
     return next_page_link[0][0]
 
 
-def next_resource_bundle(resource_type, search_params=None):
+def resource_path(resource_type):
+    """Return string form of `Resource` object or string, i.e. `Patient`"""
+    if isinstance(resource_type, Resource):
+        return resource_type.RESOURCE_TYPE
+    return resource_type
+
+
+def next_resource_bundle(resource_type, search_params=None, on_page=None):
     """Generate pages of search results, yielding bundles until exhausted
 
     :param resource_type: `Resource` object or string form of resource to look up, i.e. `Patient`
     :param search_params: optional search criteria to filter or order results
+    :param on_page: optional callback, given each page's `requests.Response`
     :returns: bundle per page until exhausted
     """
-    resource_string = (
-        resource_type.RESOURCE_TYPE
-        if isinstance(resource_type, Resource)
-        else resource_type
-    )
-    url = f"{FHIR_SERVER_URL}{resource_string}"
-    response = requests.get(url=url, params=search_params, timeout=30)
-    if has_app_context():
-        current_app.logger.debug(f"HAPI GET: {response.url}")
+    client = fhir_client()
+    response = client.get(resource_path(resource_type), params=search_params)
     response.raise_for_status()
+    if on_page:
+        on_page(response)
     bundle = response.json()
     # yield first page
     yield bundle
@@ -47,8 +50,39 @@ def next_resource_bundle(resource_type, search_params=None):
         if not next_page_link:
             return
 
-        response = requests.get(next_page_link, timeout=30)
-        current_app.logger.debug(f"HAPI GET: {response.url}")
+        response = client.get(next_page_link)
         response.raise_for_status()
+        if on_page:
+            on_page(response)
         bundle = response.json()
         yield bundle
+
+
+def next_resource_entry(resource_type, search_params=None, stream=None):
+    """Generate each `entry` of search results, over all pages until exhausted
+
+    :param resource_type: `Resource` object or string form of resource to look up
+    :param search_params: optional search criteria to filter or order results
+    :param stream: parse each page incrementally (see `BundleStream`), so
+      entries are available as the page downloads and no page is held in
+      memory whole; defaults to configured STREAM_BUNDLES
+    """
+    if not (STREAM_BUNDLES if stream is None else stream):
+        for bundle in next_resource_bundle(resource_type, search_params=search_params):
+            yield from bundle.get("entry", [])
+        return
+
+    client = fhir_client()
+    path, params = resource_path(resource_type), search_params
+    while path:
+        response = client.get(path, params=params, stream=True)
+        try:
+            response.raise_for_status()
+            page = BundleStream(response.iter_content(READ_SIZE))
+            yield from page
+        finally:
+            response.close()
+        if not page.entries:
+            return
+        # next page link is read along with the other top level fields
+        path, params = next_page_link_from_bundle(page.bundle), None
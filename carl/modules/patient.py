@@ -1,14 +1,46 @@
-"""FHIR ValueSet module"""
-import requests
-from flask import has_app_context, current_app
+"""FHIR Patient module"""
+from functools import partial
+import math
+from threading import Lock
 
-from carl.config import FHIR_SERVER_URL
-from carl.modules.coding import Coding
+from carl.config import PATIENT_HAS_FILTER, TOKEN_LIST_CHUNK_SIZE
+from carl.modules.coding import (
+    Coding,
+    coding_keys,
+    parse_token_list,
+    token_list_param,
+)
+from carl.modules.fhirclient import fhir_client
 from carl.modules.paging import next_resource_bundle
 from carl.modules.resource import Resource
+from carl.modules.valueset import ValueSetMatcher
 
 CNICS_IDENTIFIER_SYSTEM = "https://cnics.cirg.washington.edu/site-patient-id/"
 
+# Attribute holding the searchable `code` token, by resource type
+CODE_ATTRIBUTES = {
+    "Condition": "code",
+    "MedicationRequest": "medicationCodeableConcept",
+    "Observation": "code",
+}
+
+# Elements read by classification, by resource type; searches request only
+# these (`_elements`), sparing narratives, extensions and the like.  Choice
+# types are named without their type suffix, i.e. `value` for `value[x]`.
+# See also https://www.hl7.org/fhir/search.html#elements
+SEARCH_ELEMENTS = {
+    "Condition": ("code", "subject"),
+    "MedicationRequest": ("medication", "subject"),
+    "Observation": ("code", "subject", "value"),
+}
+
+
+def elements_param(resource_type):
+    """Return `_elements` search params for resource type, if projected"""
+    if resource_type not in SEARCH_ELEMENTS:
+        return {}
+    return {"_elements": ",".join(SEARCH_ELEMENTS[resource_type])}
+
 
 class Patient(Resource):
     """FHIR Patient - used for (de)serializing and queries"""
@@ -30,26 +62,407 @@ class Patient(Resource):
         return self.id()
 
 
-def patient_has(patient_id, resource_type, resource_codings, code_attribute="code"):
+class PatientContext(object):
+    """Per-patient cache of search results, shared by all classification rules
+
+    Resources referencing the patient as subject are fetched lazily, at most
+    once per distinct search, no matter how many rules consult them.  Parsed
+    codings are likewise cached per resource type and code attribute.
+
+    Alternatively, the complete set of a resource type may be `preload`ed,
+    i.e. from a bulk search, in which case searches on the `code` token are
+    answered in memory.
+
+    Pages of a resource type are only requested as consumed (see `scan`), so
+    existence checks may stop short, while later consumers pick up the
+    remaining pages rather than starting over.
+
+    Rules persisting resources for the patient defer to the context `writer`,
+    if set (see `carl.modules.batch.BatchWriter`), which records outcomes in
+    `results`, the patient's results merged from all rules.  Likewise, the
+    context `markers` (see `carl.modules.condition.MarkerIndex`) if set, holds
+    existing marker Conditions, so unchanged markers aren't rewritten.
+
+    Contexts preloaded in bulk may share `labs`, the Observation values of
+    all patients loaded alongside (see `carl.modules.observation.ObservationValues`).
+
+    Requests made for the patient's resources are counted by type in
+    `round_trips`, the cost of the data a rule consults, whichever rule
+    happened to fetch it.
+    """
+
+    def __init__(self, patient_id, writer=None, markers=None):
+        self.patient_id = patient_id
+        self.writer = writer
+        self.markers = markers
+        self.labs = None
+        self.results = {}
+        # resource_type -> requests made for patient's resources of type
+        self.round_trips = {}
+        # (resource_type, search params) -> list of resources
+        self._searches = {}
+        # (resource_type, code_attribute) -> frozenset of (system, code) keys
+        self._coding_keys = {}
+        # resource_type -> complete list of patient's resources
+        self._complete = {}
+        # resource_type -> `Scan` of partially paged resources
+        self._scans = {}
+
+    def preload(self, resource_type, resources):
+        """Provide complete list of patient's resources of given type"""
+        self._complete[resource_type] = list(resources)
+
+    def count_round_trip(self, resource_type, response=None):
+        """Count a request made for patient's resources of given type
+
+        Suitable as `on_page` callback, given a bound `resource_type`.
+        """
+        self.round_trips[resource_type] = self.round_trips.get(resource_type, 0) + 1
+
+    def fetch_cost(self, resource_types):
+        """Return count of requests made for patient's resources of given types"""
+        return sum(
+            self.round_trips.get(resource_type, 0) for resource_type in resource_types
+        )
+
+    def loaded(self, resource_type):
+        """True if all patient's resources of given type are available"""
+        return resource_type in self._complete
+
+    def _filter_complete(self, resource_type, search_params):
+        """Filter complete list of resources on given criteria, None if unable"""
+        resources = self._complete[resource_type]
+        if not search_params:
+            return resources
+        if set(search_params) != {"code"} or resource_type not in CODE_ATTRIBUTES:
+            return None
+
+        tokens = parse_token_list(search_params["code"])
+        code_attribute = CODE_ATTRIBUTES[resource_type]
+        return [
+            resource
+            for resource in resources
+            if any(
+                token_matches(token, coding)
+                for coding in resource.get(code_attribute, {}).get("coding", [])
+                for token in tokens
+            )
+        ]
+
+    def pending_scan(self, resource_type):
+        """Return `Scan` of given resource type, None if already complete"""
+        if resource_type in self._complete:
+            return None
+        if resource_type not in self._scans:
+            search_params = {"subject": self.patient_id}
+            search_params.update(elements_param(resource_type))
+            self._scans[resource_type] = Scan(
+                resource_type,
+                search_params,
+                on_page=partial(self.count_round_trip, resource_type),
+            )
+        return self._scans[resource_type]
+
+    def scan(self, resource_type):
+        """Generate patient's resources of given type, paging only as consumed"""
+        scan = self.pending_scan(resource_type)
+        if scan is None:
+            yield from self._complete[resource_type]
+            return
+
+        index = 0
+        while True:
+            while index < len(scan.resources):
+                yield scan.resources[index]
+                index += 1
+            if not scan.next_page():
+                break
+
+        self._complete[resource_type] = scan.resources
+        self._scans.pop(resource_type, None)
+
+    def resources(self, resource_type, search_params=None):
+        """Return list of patient's resources of given type and optional criteria"""
+        if not search_params:
+            return list(self.scan(resource_type))
+
+        if resource_type in self._complete:
+            resources = self._filter_complete(resource_type, search_params)
+            if resources is not None:
+                return resources
+
+        params = {"subject": self.patient_id}
+        params.update(elements_param(resource_type))
+        params.update(search_params or {})
+        key = (resource_type, tuple(sorted(params.items())))
+        if key not in self._searches:
+            resources = []
+            for bundle in next_resource_bundle(
+                resource_type,
+                search_params=params,
+                on_page=partial(self.count_round_trip, resource_type),
+            ):
+                resources.extend(entry["resource"] for entry in bundle.get("entry", []))
+            self._searches[key] = resources
+        return self._searches[key]
+
+    def coding_keys(self, resource_type, code_attribute="code"):
+        """Return frozenset of (system, code) keys from patient's resources of type"""
+        key = (resource_type, code_attribute)
+        if key not in self._coding_keys:
+            keys = set()
+            for resource in self.resources(resource_type):
+                keys.update(resource_keys(resource, code_attribute))
+            self._coding_keys[key] = frozenset(keys)
+        return self._coding_keys[key]
+
+    def codings(self, resource_type, code_attribute="code"):
+        """Return frozenset of codings from all patient's resources of given type"""
+        return frozenset(
+            Coding(system=system, code=code)
+            for system, code in self.coding_keys(resource_type, code_attribute)
+        )
+
+
+def resource_keys(resource, code_attribute="code"):
+    """Generate (system, code) key of each coding in resource's code attribute"""
+    try:
+        resource_codings = resource[code_attribute]["coding"]
+    except KeyError as deets:
+        raise ValueError(f"failed lookup, '{deets}' not in {resource}")
+    for coding in resource_codings:
+        yield coding["system"], coding["code"]
+
+
+def resource_matches(resource, matcher, code_attribute="code"):
+    """True if any coding in resource's code attribute matches `matcher`"""
+    try:
+        resource_codings = resource[code_attribute]["coding"]
+    except KeyError as deets:
+        raise ValueError(f"failed lookup, '{deets}' not in {resource}")
+    return matcher.any_match(resource_codings)
+
+
+def as_matcher(resource_codings):
+    """Return `ValueSetMatcher` for given matcher, `Coding`s or keys"""
+    if isinstance(resource_codings, ValueSetMatcher):
+        return resource_codings
+    return ValueSetMatcher.from_codings(resource_codings)
+
+
+class Scan(object):
+    """Search results, fetched a page at a time as needed"""
+
+    def __init__(self, resource_type, search_params, on_page=None):
+        """
+        :param on_page: optional callback, given each page's `requests.Response`
+        """
+        self.resources = []
+        self.pages_read = 0
+        self.bytes_read = 0
+        # as reported by first page, when server provides
+        self.total = None
+        self._on_page = on_page
+        self._pages = next_resource_bundle(
+            resource_type, search_params=search_params, on_page=self._measure
+        )
+
+    def _measure(self, response):
+        self.pages_read += 1
+        self.bytes_read += len(response.content)
+        if self._on_page:
+            self._on_page(response)
+
+    def next_page(self):
+        """Fetch the next page into `resources`, False once exhausted"""
+        bundle = next(self._pages, None)
+        if bundle is None:
+            return False
+        if self.total is None:
+            self.total = bundle.get("total")
+        self.resources.extend(entry["resource"] for entry in bundle.get("entry", []))
+        return True
+
+    def pages_remaining(self):
+        """Estimate of pages not yet fetched, 0 if unknown"""
+        if not (self.total and self.resources):
+            return 0
+        page_size = len(self.resources) / self.pages_read
+        return max(0, math.ceil(self.total / page_size) - self.pages_read)
+
+
+class ExistenceStats(object):
+    """Thread safe counters of existence queries and the I/O they avoided"""
+
+    FIELDS = (
+        "queries",
+        "short_circuits",
+        "pages_read",
+        "pages_avoided",
+        "bytes_read",
+        "bytes_avoided",
+    )
+
+    def __init__(self):
+        self._lock = Lock()
+        self._counts = dict.fromkeys(self.FIELDS, 0)
+
+    def record(self, **counts):
+        with self._lock:
+            for field, count in counts.items():
+                self._counts[field] += count
+
+    def reset(self):
+        with self._lock:
+            self._counts = dict.fromkeys(self.FIELDS, 0)
+
+    def stats(self):
+        """Return counters, suitable for summary reports"""
+        with self._lock:
+            return {f"existence_{k}": v for k, v in self._counts.items()}
+
+
+existence_stats = ExistenceStats()
+
+
+def token_matches(token, coding):
+    """Evaluate parsed FHIR token search value, (system, code), on coding
+
+    See also https://www.hl7.org/fhir/search.html#token
+    """
+    system, code = token
+    if system and coding.get("system") != system:
+        return False
+    return not code or coding.get("code") == code
+
+
+def code_filters(resource_codings, filter_mode, valueset_url=None):
+    """Generate search params restricting a search to the given codings
+
+    :param filter_mode: "valueset" to filter on `code:in` the ValueSet with
+      `valueset_url`, or comma delimited urls, any of several (requires
+      server side terminology support), otherwise
+      chunks of comma delimited `[system]|[code]` tokens
+    """
+    if filter_mode == "valueset" and valueset_url:
+        yield {"code:in": valueset_url}
+        return
+
+    # chunk to keep query strings within server url length limits
+    codings = sorted(coding_keys(resource_codings))
+    for start in range(0, len(codings), TOKEN_LIST_CHUNK_SIZE):
+        end = start + TOKEN_LIST_CHUNK_SIZE
+        yield {"code": token_list_param(codings[start:end])}
+
+
+def patient_has(
+    patient_id,
+    resource_type,
+    resource_codings,
+    code_attribute="code",
+    context=None,
+    valueset_url=None,
+    filter_mode=None,
+):
     """Determine if given patient has at least one matching resource in given codings
 
-    :returns: intersection of patient's resource with the given codings
+    :param resource_codings: set of `Coding`s, a frozenset of (system, code)
+      keys, or cheapest to match, a `ValueSetMatcher` (see `valueset_matcher`)
+    :param context: optional `PatientContext` to share fetched resources
+      between calls for the same patient
+    :param valueset_url: url of ValueSet the given codings expand, if any
+    :param filter_mode: "local" to fetch all the patient's resources of the
+      given type and intersect in memory; "tokens" or "valueset" to push the
+      code filter to the server (see `code_filters`), so only matching
+      resources are returned.  Defaults to configured PATIENT_HAS_FILTER.
+      Ignored when the context already holds all the patient's resources.
+    :returns: intersection of patient's resource with the given codings; a
+      set of `Coding`s if given `Coding`s, otherwise of (system, code) keys
     """
-    patient_codings = set()
-    for bundle in next_resource_bundle(
-        resource_type=resource_type, search_params={"subject": patient_id}
-    ):
-        for entry in bundle.get("entry", []):
-            try:
-                codings = entry["resource"][code_attribute]["coding"]
-            except KeyError as deets:
-                raise ValueError(f"failed lookup, '{deets}' not in {entry}")
-            for coding in codings:
-                patient_codings.add(
-                    Coding(system=coding["system"], code=coding["code"])
-                )
-
-    return patient_codings.intersection(resource_codings)
+    context = context or PatientContext(patient_id)
+    filter_mode = filter_mode or PATIENT_HAS_FILTER
+    matcher = as_matcher(resource_codings)
+    if filter_mode == "local" or context.loaded(resource_type):
+        patient_keys = context.coding_keys(resource_type, code_attribute)
+    else:
+        patient_keys = set()
+        for search_params in code_filters(matcher.keys(), filter_mode, valueset_url):
+            for resource in context.resources(resource_type, search_params):
+                patient_keys.update(resource_keys(resource, code_attribute))
+    found = frozenset(key for key in patient_keys if matcher.matches(*key))
+
+    if matcher is resource_codings or coding_keys(resource_codings) is resource_codings:
+        return found
+    return frozenset(coding for coding in resource_codings if coding.key in found)
+
+
+def patient_has_any(
+    patient_id,
+    resource_type,
+    resource_codings,
+    code_attribute="code",
+    context=None,
+    valueset_url=None,
+    filter_mode=None,
+):
+    """Determine if given patient has any resource matching given codings
+
+    Cheaper alternative to `patient_has` when only existence matters:
+
+    - when filtering on the server (see `patient_has` for `filter_mode`),
+      requests only a count of matching resources (`_summary=count`), stopping
+      at the first non-zero count
+    - otherwise, pages through the patient's resources only until a match is
+      found; remaining pages are left for any later consumer of the context
+
+    Pages and bytes avoided are accumulated in `existence_stats`.
+
+    :returns: True if at least one of the patient's resources matches
+    """
+    context = context or PatientContext(patient_id)
+    filter_mode = filter_mode or PATIENT_HAS_FILTER
+    matcher = as_matcher(resource_codings)
+
+    if filter_mode != "local" and not context.loaded(resource_type):
+        for search_params in code_filters(matcher.keys(), filter_mode, valueset_url):
+            params = {"subject": patient_id, "_summary": "count"}
+            params.update(search_params)
+            response = fhir_client().get(resource_type, params=params)
+            response.raise_for_status()
+            context.count_round_trip(resource_type)
+            existence_stats.record(
+                queries=1, pages_read=1, bytes_read=len(response.content)
+            )
+            if response.json().get("total"):
+                return True
+        return False
+
+    scan = context.pending_scan(resource_type)
+    pages_before = scan.pages_read if scan else 0
+    bytes_before = scan.bytes_read if scan else 0
+    found = False
+    for resource in context.scan(resource_type):
+        if resource_matches(resource, matcher, code_attribute):
+            found = True
+            break
+
+    if not scan:
+        existence_stats.record(queries=1)
+        return found
+
+    counts = {
+        "queries": 1,
+        "pages_read": scan.pages_read - pages_before,
+        "bytes_read": scan.bytes_read - bytes_before,
+    }
+    if found and not context.loaded(resource_type):
+        # stopped short of paging through all the patient's resources
+        avoided = scan.pages_remaining()
+        counts["short_circuits"] = 1
+        counts["pages_avoided"] = avoided
+        counts["bytes_avoided"] = avoided * scan.bytes_read // scan.pages_read
+    existence_stats.record(**counts)
+    return found
 
 
 def patient_canonical_identifier(patient_id, site_code):
@@ -57,10 +470,7 @@ def patient_canonical_identifier(patient_id, site_code):
     if not site_code:
         return
 
-    url = f"{FHIR_SERVER_URL}Patient/{patient_id}"
-    response = requests.get(url, timeout=30)
-    if has_app_context():
-        current_app.logger.debug(f"HAPI GET: {response.url}")
+    response = fhir_client().get(f"Patient/{patient_id}")
     response.raise_for_status()
 
     match = [
@@ -0,0 +1,135 @@
+"""Bulk fetch of Patients together with their clinical resources
+
+Rather than searching each resource type for every patient in turn, pages of
+Patients are requested with `_revinclude` parameters, so the resources
+referencing each Patient arrive in the same Bundle.  Entries are then
+demultiplexed by subject into preloaded `PatientContext`s.
+"""
+from flask import current_app
+from requests.exceptions import HTTPError
+
+from carl.config import PREFETCH_PAGE_SIZE, PREFETCH_INCLUDE_LIMIT
+from carl.modules.fhirclient import fhir_client
+from carl.modules.observation import ObservationValues
+from carl.modules.paging import next_resource_bundle
+from carl.modules.patient import PatientContext
+
+# Resources consulted by the classification rules, all referencing a subject
+CLINICAL_REVINCLUDES = (
+    "Condition:subject",
+    "MedicationRequest:subject",
+    "Observation:subject",
+)
+
+
+def server_supports_revinclude(revincludes):
+    """Check the server CapabilityStatement for given Patient `_revinclude`s"""
+    response = fhir_client().get("metadata")
+    if response.status_code != 200:
+        return False
+    for rest in response.json().get("rest", []):
+        for resource in rest.get("resource", []):
+            if resource.get("type") != "Patient":
+                continue
+            supported = set(resource.get("searchRevInclude", []))
+            return "*" in supported or supported.issuperset(revincludes)
+    return False
+
+
+def subject_id(resource):
+    """Return id of the Patient referenced as subject of given resource
+
+    Handles relative (`Patient/1`), absolute (`http://host/fhir/Patient/1`)
+    and versioned (`Patient/1/_history/2`) references alike.
+
+    See also https://www.hl7.org/fhir/references.html#literal
+    """
+    reference = resource.get("subject", {}).get("reference", "")
+    reference = reference.split("/_history/")[0]
+    segments = reference.rstrip("/").split("/")
+    if len(segments) >= 2 and segments[-2] == "Patient" and segments[-1]:
+        return segments[-1]
+
+
+def contexts_from_bundle(bundle, revincludes):
+    """Demultiplex a page of Patients and included resources by subject
+
+    :returns: list of `PatientContext`, one per matched Patient, in page
+      order.  Included resource types are only preloaded when the page looks
+      complete; HAPI silently truncates includes beyond its per page limit,
+      in which case contexts fall back to fetching on demand.  Preloaded
+      contexts share the page's Observation values as `labs`.
+    """
+    included_types = [revinclude.split(":")[0] for revinclude in revincludes]
+    contexts = {}
+    included = []
+    truncated = False
+    for entry in bundle.get("entry", []):
+        resource = entry["resource"]
+        mode = entry.get("search", {}).get("mode", "match")
+        if resource["resourceType"] == "OperationOutcome":
+            # HAPI warns via outcome entry when includes are cut short
+            truncated = True
+        elif mode == "match":
+            assert resource["resourceType"] == "Patient"
+            contexts[resource["id"]] = PatientContext(resource["id"])
+        else:
+            included.append(resource)
+
+    if truncated or len(included) >= PREFETCH_INCLUDE_LIMIT:
+        current_app.logger.warning(
+            "prefetch page includes may be incomplete, fetching on demand"
+        )
+        return list(contexts.values())
+
+    by_subject = {
+        patient_id: {resource_type: [] for resource_type in included_types}
+        for patient_id in contexts
+    }
+    for resource in included:
+        patient_id = subject_id(resource)
+        if patient_id in by_subject and resource["resourceType"] in included_types:
+            by_subject[patient_id][resource["resourceType"]].append(resource)
+
+    # Observation values of the whole page, shared by its contexts
+    labs = ObservationValues() if "Observation" in included_types else None
+    for patient_id, context in contexts.items():
+        for resource_type, resources in by_subject[patient_id].items():
+            context.preload(resource_type, resources)
+        if labs is not None:
+            labs.extend(patient_id, by_subject[patient_id]["Observation"])
+            context.labs = labs
+    return list(contexts.values())
+
+
+def prefetched_patients(search_params=None, revincludes=CLINICAL_REVINCLUDES):
+    """Generate a `PatientContext` per Patient, preloaded with its resources
+
+    Falls back to contexts fetching on demand, i.e. a plain Patient search,
+    should the server not support the requested `_revinclude`s.
+
+    :param search_params: Patient search criteria, i.e. site identifier
+    :param revincludes: `_revinclude` values, of form `[type]:subject`
+    """
+    params = dict(search_params or {})
+    if revincludes and not server_supports_revinclude(revincludes):
+        current_app.logger.warning(
+            "FHIR server lacks Patient _revinclude support, fetching on demand"
+        )
+        revincludes = ()
+    if revincludes:
+        params["_revinclude"] = list(revincludes)
+        params["_count"] = PREFETCH_PAGE_SIZE
+
+    yielded = False
+    try:
+        for bundle in next_resource_bundle("Patient", search_params=params):
+            for context in contexts_from_bundle(bundle, revincludes):
+                yielded = True
+                yield context
+    except HTTPError as error:
+        # Only recoverable before any patients were handed out
+        if yielded or not revincludes or error.response.status_code != 400:
+            raise
+        current_app.logger.warning(f"_revinclude search rejected: {error}")
+        yield from prefetched_patients(search_params, revincludes=())
@@ -1,9 +1,7 @@
 from collections import OrderedDict
-import logging
-import requests
 from urllib.parse import urlencode
 
-from carl.config import FHIR_SERVER_URL
+from carl.modules.fhirclient import fhir_client
 
 
 class Resource(object):
@@ -25,13 +23,10 @@ class Resource(object):
             return self._id
 
         # Round-trip to see if this represents a new or existing resource
-        if FHIR_SERVER_URL:
+        client = fhir_client()
+        if client.base_url:
             headers = {"Cache-Control": "no-cache"}
-            response = requests.get(
-                "/".join((FHIR_SERVER_URL, self.search_url())),
-                headers=headers,
-                timeout=30,
-            )
+            response = client.get(self.search_url(), headers=headers)
             response.raise_for_status()
 
             # extract Resource.id from bundle
@@ -95,9 +90,7 @@ def delete_resource(resource):
     but rather does a DELETE with necessary search params to prevent duplicate
     writes.  AKA conditional delete: https://www.hl7.org/fhir/http.html#cond-delete
     """
-    url = f"{FHIR_SERVER_URL}{resource.search_url()}"
-    response = requests.delete(url=url, json=resource.as_fhir(), timeout=30)
-    logging.debug(f"HAPI DELETE: {response.url}")
+    response = fhir_client().delete(resource.search_url(), json=resource.as_fhir())
     response.raise_for_status()
     return response.json()
 
@@ -109,8 +102,6 @@ def persist_resource(resource):
     but rather does a PUT with necessary search params to prevent duplicate
     writes.  AKA conditional update: https://www.hl7.org/fhir/http.html#cond-update
     """
-    url = f"{FHIR_SERVER_URL}{resource.search_url()}"
-    response = requests.put(url=url, json=resource.as_fhir(), timeout=30)
-    logging.debug(f"HAPI PUT: {response.url}")
+    response = fhir_client().put(resource.search_url(), json=resource.as_fhir())
     response.raise_for_status()
     return response.json()
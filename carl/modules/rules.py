@@ -0,0 +1,502 @@
+"""Declarative classification rules, compiled into a minimal query plan
+
+Each `Rule` names the marker Condition coding persisted for patients meeting
+its criteria, expressed in a small Python DSL::
+
+    Rule(
+        marker=CNICS_diabetes_coding,
+        criteria=AnyOf(
+            ValueAtLeast(A1C_observation_coding, 6.5),
+            HasCoding("MedicationRequest", SPECIFIC_MEDICATION_VALUESET_URL),
+            AllOf(
+                HasCoding("MedicationRequest", RELATED_MEDICATION_VALUESET_URL),
+                HasCoding("Condition", CONDITIONS_VALUESET_URL),
+            ),
+        ),
+    )
+
+Criteria are evaluated in the order given, `AllOf` and `AnyOf` stopping as
+soon as the outcome is known.  A rule may also require another to be met.
+In "adaptive" RULE_ORDER, the branches of `AnyOf`, being commutative, are
+instead ordered by the cost and match rate learned so far (see
+`CriterionStats`), so cheap, frequently matching branches are tried first.
+A criterion's cost is the round trips fetching the resource types it reads,
+whichever criterion made them, so learned order doesn't merely reflect the
+order evaluated, or what earlier criteria left cached.
+
+Rules are `register`ed with `enabled_rules`, whose `QueryPlan` merges the
+data consulted by every rule into a single fetch per resource type and
+patient; a rule consulting resource types other rules already consult costs
+no further round trips.  When filtering on the server, the search is of the
+codes or ValueSets of every rule consulting the type, each rule matching its
+own from the shared results.
+"""
+from abc import ABC, abstractmethod
+from threading import Lock
+
+from carl.config import PATIENT_HAS_FILTER, RULE_ORDER
+from carl.modules.condition import (
+    mark_patient_with_condition,
+    unmark_patient_with_condition,
+)
+from carl.modules.observation import observation_value
+from carl.modules.patient import (
+    CODE_ATTRIBUTES,
+    PatientContext,
+    code_filters,
+    patient_has_any,
+    resource_matches,
+)
+from carl.modules.valueset import ValueSetMatcher, valueset_matcher
+
+# Evaluations of each branch before adaptive ordering trusts its statistics
+MIN_SAMPLES = 20
+
+
+class CriterionStats(object):
+    """Thread safe, per criterion counts of evaluations, matches and round trips"""
+
+    def __init__(self):
+        self._lock = Lock()
+        # criterion name -> [evaluated, matched, round trips]
+        self._counts = {}
+
+    def record(self, name, matched, round_trips):
+        with self._lock:
+            counts = self._counts.setdefault(name, [0, 0, 0])
+            counts[0] += 1
+            counts[1] += int(matched)
+            counts[2] += round_trips
+
+    def reset(self):
+        with self._lock:
+            self._counts = {}
+
+    def rank(self, name):
+        """Expected round trips per match, None until MIN_SAMPLES evaluated
+
+        Match rate is smoothed (add one), so a criterion yet to match ranks
+        by cost rather than infinitely.
+        """
+        with self._lock:
+            evaluated, matched, round_trips = self._counts.get(name, (0, 0, 0))
+        if evaluated < MIN_SAMPLES:
+            return None
+        return (round_trips / evaluated) / ((matched + 1) / (evaluated + 2))
+
+    def ordered(self, criteria):
+        """Return given criteria, cheapest per match first
+
+        Declared order is kept until every criterion has a `rank`.
+        """
+        ranks = [self.rank(criterion.name) for criterion in criteria]
+        if None in ranks:
+            return criteria
+        # sort is stable, so ties keep declared order
+        order = sorted(range(len(criteria)), key=ranks.__getitem__)
+        return tuple(criteria[i] for i in order)
+
+    def stats(self):
+        """Return counters by criterion name, suitable for summary reports"""
+        with self._lock:
+            counts = sorted(self._counts.items())
+        return {
+            "criteria_evaluated": {name: c[0] for name, c in counts},
+            "criteria_matched": {name: c[1] for name, c in counts},
+            "criteria_round_trips": {name: c[2] for name, c in counts},
+        }
+
+
+criterion_stats = CriterionStats()
+
+
+class Criterion(ABC):
+    """Base class of rule criteria
+
+    Subclasses implement `name` and `test`; `evaluate` notes the outcome, to
+    be recorded in `criterion_stats` once the patient's rules are applied
+    (see `Evaluation.record_stats`).
+    """
+
+    @property
+    @abstractmethod
+    def name(self):
+        """Key of the criterion's statistics, unique among enabled rules"""
+
+    def sources(self):
+        """Generate (resource_type, source) of each datum consulted
+
+        A source is either a ValueSet url, or a (system, code) key.
+        """
+        return ()
+
+    def evaluate(self, evaluation):
+        """True if the patient of given `Evaluation` meets the criterion"""
+        met = self.test(evaluation)
+        evaluation.evaluated.append((self, met))
+        return met
+
+    @abstractmethod
+    def test(self, evaluation):
+        """True if the patient meets the criterion, recording `results`"""
+
+
+class HasCoding(Criterion):
+    """Patient has a resource of given type, coded from given ValueSet
+
+    Given "local" filter mode, or a context preloaded with the type, an
+    existence check (see `patient_has_any`) paging only until a match is
+    found; otherwise matched from the plan's search of the type, shared with
+    every rule consulting it.
+    """
+
+    def __init__(self, resource_type, valueset_url, label=None):
+        """
+        :param label: results key prefix, defaults to the ValueSet name
+        """
+        self.resource_type = resource_type
+        self.valueset_url = valueset_url
+        self.label = label or valueset_url.split("/")[-1]
+
+    @property
+    def name(self):
+        return self.label
+
+    def sources(self):
+        yield self.resource_type, self.valueset_url
+
+    def test(self, evaluation):
+        matcher = valueset_matcher(self.valueset_url)
+        code_attribute = CODE_ATTRIBUTES[self.resource_type]
+        context = evaluation.context
+        if evaluation.plan.filter_mode == "local" or context.loaded(self.resource_type):
+            found = patient_has_any(
+                evaluation.patient_id,
+                self.resource_type,
+                matcher,
+                code_attribute,
+                context=context,
+                filter_mode="local",
+            )
+        else:
+            found = any(
+                resource_matches(resource, matcher, code_attribute)
+                for resource in evaluation.scan(self.resource_type)
+            )
+        evaluation.results[f"{self.label} found"] = found
+        return found
+
+
+class ValueAtLeast(Criterion):
+    """Patient has an Observation with given coding, valued at least threshold
+
+    Answered from the context `labs` when set, evaluating the threshold over
+    the patient's entire page or population at once.
+    """
+
+    def __init__(self, coding, threshold, label=None):
+        """
+        :param label: results key prefix, defaults to the coding's code
+        """
+        self.coding = coding
+        self.threshold = threshold
+        self.label = label or coding.code
+        self._matcher = ValueSetMatcher.from_codings([coding])
+
+    @property
+    def name(self):
+        return f"{self.label} >= {self.threshold}"
+
+    def sources(self):
+        yield "Observation", self.coding.key
+
+    def test(self, evaluation):
+        labs = evaluation.context.labs
+        if labs is not None:
+            key, patient_id = self.coding.key, evaluation.patient_id
+            count = labs.counts(key).get(patient_id, 0)
+            found = patient_id in labs.at_least(key, self.threshold)
+        else:
+            values = [
+                observation_value(resource)
+                for resource in evaluation.scan("Observation")
+                # i.e. preloaded, uncoded Observations can't match
+                if resource.get("code", {}).get("coding")
+                and resource_matches(resource, self._matcher)
+            ]
+            count = len(values)
+            threshold = float(self.threshold)
+            found = any(value is not None and value >= threshold for value in values)
+        evaluation.results[f"{self.label} count"] = count
+        evaluation.results[f"{self.name} found"] = found
+        return found
+
+
+class AllOf(Criterion):
+    """Met if all given criteria are, evaluated in order until one is not"""
+
+    def __init__(self, *criteria):
+        self.criteria = criteria
+
+    @property
+    def name(self):
+        names = ", ".join(criterion.name for criterion in self.criteria)
+        return f"{type(self).__name__}({names})"
+
+    def sources(self):
+        for criterion in self.criteria:
+            yield from criterion.sources()
+
+    def test(self, evaluation):
+        return all(criterion.evaluate(evaluation) for criterion in self.criteria)
+
+
+class AnyOf(AllOf):
+    """Met if any given criterion is, evaluated in order until one is
+
+    Given an adaptive `Evaluation`, in order of `CriterionStats.rank`.
+    """
+
+    def test(self, evaluation):
+        criteria = self.criteria
+        if evaluation.adaptive:
+            criteria = criterion_stats.ordered(criteria)
+        return any(criterion.evaluate(evaluation) for criterion in criteria)
+
+
+class Rule(object):
+    """Marker Condition coding, persisted for patients meeting given criteria"""
+
+    def __init__(self, marker, criteria, requires=None):
+        """
+        :param marker: `Coding` of the marker Condition
+        :param criteria: `Criterion` the patient must meet
+        :param requires: optional `Rule` to be met first, its criteria
+          evaluated in lieu of this one's otherwise
+        """
+        self.marker = marker
+        self.criteria = criteria
+        self.requires = requires
+
+    def __repr__(self):
+        return f"<Rule {self.marker.code}>"
+
+    def sources(self):
+        return self.criteria.sources()
+
+    def met(self, evaluation):
+        """True if the patient meets the rule, evaluated once per `Evaluation`"""
+        if self not in evaluation.outcomes:
+            evaluation.outcomes[self] = (
+                self.requires is None or self.requires.met(evaluation)
+            ) and self.criteria.evaluate(evaluation)
+        return evaluation.outcomes[self]
+
+    def apply(self, evaluation):
+        """Persist the marker if the patient meets the rule, else retract it"""
+        patient_id, context = evaluation.patient_id, evaluation.context
+        if self.met(evaluation):
+            mark_patient_with_condition(
+                patient_id, self.marker, evaluation.results, context
+            )
+        else:
+            # retract any marker from a previous run
+            unmark_patient_with_condition(
+                patient_id, self.marker, evaluation.results, context, if_known=True
+            )
+
+
+class Evaluation(object):
+    """State of evaluating rules for a single patient"""
+
+    def __init__(self, patient_id, context, plan, adaptive=False):
+        self.patient_id = patient_id
+        self.context = context
+        self.plan = plan
+        self.adaptive = adaptive
+        self.results = {"patient_id": patient_id}
+        # `Rule` -> True if met
+        self.outcomes = {}
+        # (`Criterion`, True if met), in order evaluated
+        self.evaluated = []
+
+    def scan(self, resource_type):
+        """Generate patient's resources of given type, as fetched by the plan"""
+        return self.plan.scan(self.context, resource_type)
+
+    def record_stats(self):
+        """Record outcome of each criterion evaluated in `criterion_stats`
+
+        Each is charged all the patient's round trips for the resource types
+        it reads, as fetched once every rule is applied, whichever criterion
+        made them.
+        """
+        for criterion, met in self.evaluated:
+            resource_types = {resource_type for resource_type, _ in criterion.sources()}
+            cost = self.context.fetch_cost(resource_types)
+            criterion_stats.record(criterion.name, met, cost)
+
+
+class QueryPlan(object):
+    """Deduplicated fetches of the data consulted by a set of rules
+
+    Per resource type, the sources of every criterion are merged, and each
+    patient's resources of the type are fetched once, shared by all rules:
+    either all of them, paging only as consumed (given "local" filter mode,
+    or a context already preloaded with the type), or only those matching
+    any source, filtering on the server (see `carl.modules.patient.code_filters`).
+    Types consulted only for given codings are always filtered on the server.
+
+    Given "valueset" filter mode, a type consulted only for ValueSets is
+    searched `code:in` any of them, a single comma delimited (OR) parameter.
+    """
+
+    def __init__(self, rules, filter_mode=None):
+        """
+        :param filter_mode: defaults to configured PATIENT_HAS_FILTER
+        """
+        self.filter_mode = filter_mode or PATIENT_HAS_FILTER
+        # resource_type -> list of distinct sources, in rule order
+        self.sources = {}
+        for rule in rules:
+            for resource_type, source in rule.sources():
+                sources = self.sources.setdefault(resource_type, [])
+                if source not in sources:
+                    sources.append(source)
+        # (system, code) key source -> `ValueSetMatcher`
+        self._key_matchers = {
+            source: ValueSetMatcher.from_codings([source])
+            for sources in self.sources.values()
+            for source in sources
+            if isinstance(source, tuple)
+        }
+        # resource_type -> (source matchers, union `ValueSetMatcher`)
+        self._unions = {}
+
+    def matcher(self, resource_type):
+        """Return `ValueSetMatcher` of all codes consulted for resource type
+
+        Recompiled only when a ValueSet changes revision.
+        """
+        parts = tuple(
+            (
+                self._key_matchers[source]
+                if isinstance(source, tuple)
+                else valueset_matcher(source)
+            )
+            for source in self.sources[resource_type]
+        )
+        cached = self._unions.get(resource_type)
+        if cached and all(a is b for a, b in zip(cached[0], parts)):
+            return cached[1]
+        union = ValueSetMatcher.union(parts)
+        self._unions[resource_type] = (parts, union)
+        return union
+
+    def searches(self, resource_type):
+        """Return list of search params fetching a patient's resources of type
+
+        Types consulted only for given codings (i.e. lab values) are always
+        searched by `code` token, whatever the filter mode, sparing a fetch of
+        all the patient's resources of the type.
+        """
+        sources = self.sources.get(resource_type)
+        if not sources:
+            return [{}]
+        keys_only = all(isinstance(source, tuple) for source in sources)
+        if self.filter_mode == "local" and not keys_only:
+            return [{}]
+        valueset_url = None
+        if all(isinstance(source, str) for source in sources):
+            valueset_url = ",".join(sources)
+        filter_mode = "tokens" if self.filter_mode == "local" else self.filter_mode
+        return list(
+            code_filters(self.matcher(resource_type).keys(), filter_mode, valueset_url)
+        )
+
+    def scan(self, context, resource_type):
+        """Generate patient's resources of given type, fetching only as consumed"""
+        searches = [{}]
+        if not context.loaded(resource_type):
+            searches = self.searches(resource_type)
+        if searches == [{}]:
+            yield from context.scan(resource_type)
+            return
+
+        seen = set()
+        for search_params in searches:
+            for resource in context.resources(resource_type, search_params):
+                # a resource may match more than one chunk of tokens
+                resource_id = resource.get("id")
+                if resource_id in seen:
+                    continue
+                if resource_id is not None:
+                    seen.add(resource_id)
+                yield resource
+
+    def describe(self):
+        """Return the plan as JSON serializable dict, by resource type"""
+        return {
+            resource_type: {
+                "sources": [
+                    source if isinstance(source, str) else "|".join(source)
+                    for source in sources
+                ],
+                "searches": len(self.searches(resource_type)),
+            }
+            for resource_type, sources in self.sources.items()
+        }
+
+
+class RuleRegistry(object):
+    """Enabled rules, and the `QueryPlan` compiled from them"""
+
+    def __init__(self):
+        self.rules = []
+        self._plan = None
+        self._lock = Lock()
+
+    def register(self, *rules):
+        """Enable given rules, recompiling the plan on next use
+
+        :returns: the given rules, as a tuple
+        """
+        with self._lock:
+            for rule in rules:
+                if rule not in self.rules:
+                    self.rules.append(rule)
+            self._plan = None
+        return rules
+
+    def plan(self):
+        """Return `QueryPlan` of all enabled rules"""
+        with self._lock:
+            if self._plan is None:
+                self._plan = QueryPlan(self.rules)
+            return self._plan
+
+
+enabled_rules = RuleRegistry()
+
+
+def classify(patient_id, rules, context=None, plan=None, adaptive=None):
+    """Apply given rules in order to patient, persisting or retracting markers
+
+    :param context: optional `PatientContext` to share fetched resources with
+      other classifiers run on the same patient
+    :param plan: `QueryPlan` to fetch by; defaults to that of `enabled_rules`,
+      sharing fetches with all enabled rules, whichever evaluate them
+    :param adaptive: order `AnyOf` branches by learned cost and match rate,
+      defaults to configured RULE_ORDER being "adaptive"
+    :returns: results dict, with a `<marker.code>_matched` key per rule met
+    """
+    context = context or PatientContext(patient_id)
+    if adaptive is None:
+        adaptive = RULE_ORDER == "adaptive"
+    evaluation = Evaluation(
+        patient_id, context, plan or enabled_rules.plan(), adaptive=adaptive
+    )
+    for rule in rules:
+        rule.apply(evaluation)
+    evaluation.record_stats()
+    return evaluation.results
@@ -0,0 +1,106 @@
+"""Disk backed spool of resource ids, consumable while still being enumerated
+
+Enumerating a large search must outpace HAPI's paging timeouts, whereas
+processing each resource may be slow; ids are paged in a background thread,
+spilled to a temporary file, and consumed at the pace of processing.
+"""
+from itertools import islice
+from tempfile import TemporaryFile
+from threading import Condition, Thread
+
+from carl.modules.paging import next_resource_entry
+
+# Bytes read from the spool at a time
+READ_SIZE = 64 * 1024
+
+# Ids appended to the spool at a time
+WRITE_SIZE = 512
+
+
+class IdSpool(object):
+    """Append only, file backed sequence of ids, iterable while being written
+
+    Memory use is flat regardless of the number of ids; only a newline
+    delimited file and a read buffer are held.  Iterating blocks for further
+    ids until the spool is `close`d, re-raising any error the writer closed
+    it with.  A spool is consumed once; the file is removed when exhausted.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._file = TemporaryFile()
+        self._condition = Condition()
+        self._size = 0
+        self._closed = False
+        self._error = None
+
+    def extend(self, ids):
+        """Append given ids"""
+        ids = list(ids)
+        data = "".join(f"{resource_id}\n" for resource_id in ids).encode()
+        with self._condition:
+            self._file.seek(0, 2)
+            self._file.write(data)
+            self._file.flush()
+            self._size += len(data)
+            self.count += len(ids)
+            self._condition.notify_all()
+
+    def close(self, error=None):
+        """Mark the spool complete, or failed with given error"""
+        with self._condition:
+            self._closed = True
+            self._error = error
+            self._condition.notify_all()
+
+    def __iter__(self):
+        position = 0
+        while True:
+            with self._condition:
+                while position == self._size and not self._closed:
+                    self._condition.wait()
+                if self._error:
+                    self._file.close()
+                    raise self._error
+                if position == self._size:
+                    self._file.close()
+                    return
+                self._file.seek(position)
+                data = self._file.read(min(READ_SIZE, self._size - position))
+
+            # writes are whole lines; cut the read at the last complete one
+            data = data[: data.rfind(b"\n") + 1]
+            position += len(data)
+            for line in data.splitlines():
+                yield line.decode()
+
+
+def spool_search_ids(app, resource_type, search_params=None):
+    """Spool ids of all resources matching search, paged in a background thread
+
+    Only ids are requested (`_elements=id`) to keep pages small.
+
+    :param app: Flask app, providing context to the background thread
+    :returns: `IdSpool`, iterable as ids arrive
+    """
+    params = dict(search_params or {})
+    params["_elements"] = "id"
+    spool = IdSpool()
+
+    def enumerate_ids():
+        with app.app_context():
+            try:
+                entries = next_resource_entry(resource_type, search_params=params)
+                while True:
+                    ids = [e["resource"]["id"] for e in islice(entries, WRITE_SIZE)]
+                    if not ids:
+                        break
+                    spool.extend(ids)
+            except Exception as error:
+                app.logger.error(f"{resource_type} enumeration failed: {error}")
+                spool.close(error)
+            else:
+                spool.close()
+
+    Thread(target=enumerate_ids, name="carl-spool", daemon=True).start()
+    return spool
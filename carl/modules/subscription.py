@@ -0,0 +1,56 @@
+"""FHIR Subscription (REST hook) notification handling
+
+Notifications name changed clinical resources; the patients referenced as
+their subject are those in need of reclassification.
+
+See also https://www.hl7.org/fhir/subscription.html#2.46.7.1
+"""
+from carl.modules.condition import is_marker
+from carl.modules.fhirclient import fhir_client
+from carl.modules.prefetch import subject_id
+
+# Resource types consulted by the classification rules
+NOTIFY_TYPES = ("Condition", "MedicationRequest", "Observation")
+
+
+def notified_resources(payload):
+    """Generate resources from notification payload; a Bundle or single resource"""
+    if not payload:
+        return
+    if payload.get("resourceType") == "Bundle":
+        for entry in payload.get("entry", []):
+            if "resource" in entry:
+                yield entry["resource"]
+    else:
+        yield payload
+
+
+def notification_subjects(payload, marker_codings=()):
+    """Return set of Patient ids referenced as subject in given notification
+
+    Resources of other than `NOTIFY_TYPES` (i.e. a `SubscriptionStatus`) are
+    ignored, as are marker Conditions, lest classification writes trigger
+    further classification.
+    """
+    patient_ids = set()
+    for resource in notified_resources(payload):
+        if resource.get("resourceType") not in NOTIFY_TYPES:
+            continue
+        if is_marker(resource, marker_codings):
+            continue
+        patient_id = subject_id(resource)
+        if patient_id:
+            patient_ids.add(patient_id)
+    return patient_ids
+
+
+def fetch_resource(resource_type, resource_id):
+    """Look up a notified resource, for notifications sent without payload
+
+    :returns: the resource, or None if no longer found (i.e. deleted)
+    """
+    response = fhir_client().get(f"{resource_type}/{resource_id}")
+    if response.status_code in (404, 410):
+        return None
+    response.raise_for_status()
+    return response.json()
@@ -0,0 +1,57 @@
+"""Summary reports of batch runs, and merging those of sharded runs"""
+import json
+
+# Counters reported as the maximum, rather than sum, over shards
+MAX_FIELDS = ("duration",)
+
+
+def write_summary(path, summary):
+    """Write summary report to given path as JSON"""
+    with open(path, "w") as summary_file:
+        json.dump(summary, summary_file, indent=2, default=str)
+
+
+def seconds(duration):
+    """Parse duration as reported in summaries, i.e. "12.3400 seconds" """
+    return float(str(duration).split()[0])
+
+
+def merge_summaries(summaries):
+    """Merge summary reports of shards of one run into a single report
+
+    Numeric counters (and nested dicts of counters) are summed; `duration`,
+    as the shards run concurrently, is the longest.  Other values are kept
+    when all shards agree, otherwise listed.
+    """
+    merged = {"shards": len(summaries)}
+    keys = []
+    for summary in summaries:
+        keys.extend(key for key in summary if key not in keys)
+
+    for key in keys:
+        values = [summary[key] for summary in summaries if key in summary]
+        if key in MAX_FIELDS:
+            merged[key] = f"{max(seconds(value) for value in values):.4f} seconds"
+        elif all(isinstance(value, dict) for value in values):
+            merged[key] = merge_counts(values)
+        elif all(
+            isinstance(value, (int, float)) and not isinstance(value, bool)
+            for value in values
+        ):
+            merged[key] = sum(values)
+        else:
+            distinct = []
+            for value in values:
+                if value not in distinct:
+                    distinct.append(value)
+            merged[key] = distinct[0] if len(distinct) == 1 else distinct
+    return merged
+
+
+def merge_counts(counts):
+    """Sum given list of dicts of counters"""
+    merged = {}
+    for count in counts:
+        for key, value in count.items():
+            merged[key] = merged.get(key, 0) + value
+    return merged
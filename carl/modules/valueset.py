@@ -1,8 +1,10 @@
 """FHIR ValueSet module"""
-import requests
+from threading import RLock
+import timeit
 
-from carl.config import FHIR_SERVER_URL
-from carl.modules.coding import Coding
+from carl.config import VALUESET_CACHE_TTL
+from carl.modules.coding import Coding, coding_key, coding_keys
+from carl.modules.fhirclient import fhir_client
 from carl.modules.resource import Resource
 
 
@@ -26,25 +28,227 @@ class ValueSet(Resource):
         return cls(url=data["url"])
 
 
-# TODO: cache this never changing round-trip
-def valueset_codings(url):
-    """Obtain set of codings in matching ValueSet by url field"""
+def valueset_version(value_set):
+    """Return key identifying the revision of given ValueSet (JSON) data
+
+    Combines the business `version` with the server assigned `meta.versionId`,
+    either of which changes when the ValueSet content is modified.
+    """
+    return value_set.get("version"), value_set.get("meta", {}).get("versionId")
+
+
+def expand_valueset(value_set):
+    """Return frozenset of codings included in given ValueSet (JSON) data"""
+    codings = set()
+    for entry in value_set.get("compose").get("include"):
+        # By system, then nested codes - parse and add.
+        system = entry["system"]
+        for concept in entry.get("concept"):
+            codings.add(Coding(system=system, code=concept["code"]))
+    return frozenset(codings)
+
+
+class ValueSetMatcher(object):
+    """Compiled ValueSet membership test, codes indexed by system
+
+    Matching a resource's codings takes a dict and a set lookup apiece,
+    allocating nothing.  Built once per ValueSet revision (see
+    `ValueSetCache`), or from any collection of codings via `from_codings`.
+    """
+
+    __slots__ = ("_codes", "_keys")
+
+    def __init__(self, codes_by_system):
+        """:param codes_by_system: dict of system -> iterable of codes"""
+        self._codes = {
+            system: frozenset(codes) for system, codes in codes_by_system.items()
+        }
+        self._keys = None
+
+    @classmethod
+    def from_valueset(cls, value_set):
+        """Compile from `compose.include` of given ValueSet (JSON) data"""
+        codes_by_system = {}
+        for entry in value_set.get("compose").get("include"):
+            codes = codes_by_system.setdefault(entry["system"], set())
+            codes.update(concept["code"] for concept in entry.get("concept"))
+        return cls(codes_by_system)
+
+    @classmethod
+    def from_codings(cls, codings):
+        """Compile from given `Coding`s or (system, code) keys"""
+        codes_by_system = {}
+        for system, code in coding_keys(codings):
+            codes_by_system.setdefault(system, set()).add(code)
+        return cls(codes_by_system)
+
+    @classmethod
+    def union(cls, matchers):
+        """Compile a matcher of the codes in any of given matchers"""
+        codes_by_system = {}
+        for matcher in matchers:
+            for system, codes in matcher._codes.items():
+                codes_by_system.setdefault(system, set()).update(codes)
+        return cls(codes_by_system)
+
+    def __len__(self):
+        return sum(len(codes) for codes in self._codes.values())
+
+    def __contains__(self, key):
+        return self.matches(*key)
+
+    def matches(self, system, code):
+        """True if the coding with given system and code is in the ValueSet"""
+        codes = self._codes.get(system)
+        return codes is not None and code in codes
+
+    def any_match(self, codings):
+        """True if any of given codings (JSON) is in the ValueSet"""
+        for coding in codings:
+            codes = self._codes.get(coding.get("system"))
+            if codes is not None and coding.get("code") in codes:
+                return True
+        return False
+
+    def keys(self):
+        """Return frozenset of interned (system, code) keys, see `coding_key`"""
+        if self._keys is None:
+            self._keys = frozenset(
+                coding_key(system, code)
+                for system, codes in self._codes.items()
+                for code in codes
+            )
+        return self._keys
+
+
+def fetch_valueset(url):
+    """Round-trip to obtain ValueSet (JSON) data with matching url field"""
     search_params = {"url": url}
-    resource_path = f"{FHIR_SERVER_URL}ValueSet"
-    response = requests.get(resource_path, params=search_params, timeout=30)
+    response = fhir_client().get("ValueSet", params=search_params)
     response.raise_for_status()
     bundle = response.json()
     if bundle["total"] != 1:
         raise ValueError(
             f"Expected ValueSet {url} not found; Did `flask bootstrap` get called?"
         )
+    return bundle["entry"][0]["resource"]
 
-    value_set = bundle["entry"][0]["resource"]
-    codings = set()
-    for entry in value_set.get("compose").get("include"):
-        # By system, then nested codes - parse and add.
-        system = entry["system"]
-        for concept in entry.get("concept"):
-            codings.add(Coding(system=system, code=concept["code"]))
 
-    return codings
+class ValueSetCache(object):
+    """Process-wide cache of ValueSet expansions
+
+    Expansions are keyed by ValueSet url and revision (see `valueset_version`)
+    and handed out as immutable frozensets of `Coding`s, safe to share between
+    threads, along with a compiled `ValueSetMatcher` for matching.
+    Once `ttl` seconds pass, the next request for a url re-fetches the
+    ValueSet; an unchanged revision reuses the existing expansion.
+    """
+
+    def __init__(self, ttl=0):
+        """:param ttl: seconds before an entry is re-checked, 0 for never"""
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = RLock()
+        # url -> (revision, time fetched)
+        self._current = {}
+        # (url, revision) -> frozenset of codings
+        self._expansions = {}
+        # (url, revision) -> `ValueSetMatcher`
+        self._matchers = {}
+
+    def _fresh(self, url):
+        if url not in self._current:
+            return False
+        if not self.ttl:
+            return True
+        fetched = self._current[url][1]
+        return timeit.default_timer() - fetched < self.ttl
+
+    def add(self, value_set):
+        """Add (or refresh) given ValueSet (JSON) data, return its expansion"""
+        return self._add(value_set)[0]
+
+    def _add(self, value_set):
+        url = value_set["url"]
+        revision = valueset_version(value_set)
+        with self._lock:
+            key = (url, revision)
+            if key not in self._expansions:
+                self._expansions[key] = expand_valueset(value_set)
+                self._matchers[key] = ValueSetMatcher.from_valueset(value_set)
+            self._current[url] = (revision, timeit.default_timer())
+            return self._expansions[key], self._matchers[key]
+
+    def _lookup(self, url):
+        with self._lock:
+            if self._fresh(url):
+                self.hits += 1
+                key = (url, self._current[url][0])
+                return self._expansions[key], self._matchers[key]
+            self.misses += 1
+
+        # round-trip outside the lock, concurrent misses are harmless
+        return self._add(fetch_valueset(url))
+
+    def codings(self, url):
+        """Return frozenset of codings in ValueSet with given url"""
+        return self._lookup(url)[0]
+
+    def matcher(self, url):
+        """Return `ValueSetMatcher` for ValueSet with given url"""
+        return self._lookup(url)[1]
+
+    def keys(self, url):
+        """Return frozenset of (system, code) keys in ValueSet with given url"""
+        return self.matcher(url).keys()
+
+    def invalidate(self, url=None):
+        """Drop cached expansion for given url, or all if url is None"""
+        with self._lock:
+            if url is None:
+                self._current.clear()
+                self._expansions.clear()
+                self._matchers.clear()
+                return
+            self._current.pop(url, None)
+            for key in [key for key in self._expansions if key[0] == url]:
+                del self._expansions[key]
+                del self._matchers[key]
+
+    def stats(self):
+        """Return hit/miss counters, suitable for summary reports"""
+        with self._lock:
+            return {
+                "valueset_cache_hits": self.hits,
+                "valueset_cache_misses": self.misses,
+                "valueset_cache_size": len(self._current),
+            }
+
+
+valueset_cache = ValueSetCache(ttl=VALUESET_CACHE_TTL)
+
+
+def valueset_codings(url):
+    """Obtain frozenset of codings in matching ValueSet by url field
+
+    Served from the process-wide `valueset_cache`, only round-tripping to
+    FHIR_SERVER_URL on first use or after the cache entry expires.
+    """
+    return valueset_cache.codings(url)
+
+
+def valueset_keys(url):
+    """Obtain frozenset of (system, code) keys in matching ValueSet by url field
+
+    Cheaper to match against than `valueset_codings`; see `coding_key`.
+    """
+    return valueset_cache.keys(url)
+
+
+def valueset_matcher(url):
+    """Obtain compiled `ValueSetMatcher` for matching ValueSet by url field
+
+    The cheapest means of matching codings; see also `valueset_keys`.
+    """
+    return valueset_cache.matcher(url)
@@ -0,0 +1,95 @@
+"""High-water marks for incremental classification
+
+Between runs, only the patients referenced as subject by clinical resources
+updated since the previous run need reclassifying.  Each run persists the
+FHIR server time it started at, per site, and the following run searches
+each clinical resource type with `_lastUpdated=gt[mark]`.
+
+NB - deleted resources don't appear in `_lastUpdated` searches; a full run
+remains necessary to account for deletions.
+"""
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import json
+import os
+
+from carl.modules.condition import is_marker
+from carl.modules.fhirclient import fhir_client
+from carl.modules.paging import next_resource_entry
+from carl.modules.patient import CODE_ATTRIBUTES
+from carl.modules.prefetch import subject_id
+
+# Resource types consulted by the classification rules
+INCREMENTAL_TYPES = ("Condition", "MedicationRequest", "Observation")
+
+# Watermark key used when classifying all sites
+ALL_SITES = "*"
+
+
+def load_watermark(path, site=None):
+    """Return the persisted watermark for given site, None if not found"""
+    if not (path and os.path.exists(path)):
+        return None
+    with open(path) as watermark_file:
+        return json.load(watermark_file).get(site or ALL_SITES)
+
+
+def save_watermark(path, mark, site=None):
+    """Persist watermark for given site, replacing the file atomically"""
+    marks = {}
+    if os.path.exists(path):
+        with open(path) as watermark_file:
+            marks = json.load(watermark_file)
+    marks[site or ALL_SITES] = mark
+
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as watermark_file:
+        json.dump(marks, watermark_file, indent=2)
+    os.replace(temp_path, path)
+
+
+def clear_watermarks(path):
+    """Remove all persisted watermarks, forcing the next run to be full"""
+    if path and os.path.exists(path):
+        os.remove(path)
+
+
+def server_time():
+    """Return current FHIR server time as an ISO instant
+
+    Taken from the `Date` header of a minimal search, so the watermark is
+    comparable with `meta.lastUpdated` regardless of local clock skew.
+    Falls back to local time should the server not report one.
+    """
+    response = fhir_client().get("Patient", params={"_summary": "count"})
+    date = response.headers.get("Date")
+    now = parsedate_to_datetime(date) if date else datetime.now(timezone.utc)
+    return now.astimezone(timezone.utc).isoformat(timespec="seconds")
+
+
+def updated_subjects(since, search_params=None, ignore_codings=()):
+    """Return set of Patient ids with clinical resources updated since `since`
+
+    :param since: watermark, i.e. as returned from `server_time`
+    :param search_params: additional criteria for each search, i.e. a
+      chained `subject:Patient.identifier` to restrict to a site
+    :param ignore_codings: Condition codings to disregard, i.e. the markers
+      persisted by classification itself
+    """
+    patient_ids = set()
+    for resource_type in INCREMENTAL_TYPES:
+        code_attribute = CODE_ATTRIBUTES[resource_type]
+        params = {
+            "_lastUpdated": f"gt{since}",
+            "_elements": f"subject,{code_attribute}",
+            "_count": 512,
+        }
+        params.update(search_params or {})
+        for entry in next_resource_entry(resource_type, search_params=params):
+            resource = entry["resource"]
+            if is_marker(resource, ignore_codings):
+                continue
+            patient_id = subject_id(resource)
+            if patient_id:
+                patient_ids.add(patient_id)
+    return patient_ids
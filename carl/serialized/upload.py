@@ -1,9 +1,10 @@
 import json
 import os
-import requests
 from flask import abort, current_app
 
 from carl.modules.factories import deserialize_resource
+from carl.modules.fhirclient import fhir_client
+from carl.modules.valueset import ValueSet, valueset_cache
 
 
 def load_files():
@@ -35,8 +36,28 @@ def load_files():
                 endpoint += resource.search_url()
 
             current_app.logger.info(f"PUT {fname.name} to {endpoint}")
-            response = requests.put(endpoint, json=data, timeout=30)
+            response = fhir_client().put(endpoint, json=data)
             current_app.logger.info(
                 f"status {response.status_code}, text {response.text}"
             )
             response.raise_for_status()
+
+            if data["resourceType"] == ValueSet.RESOURCE_TYPE:
+                # Warm cache with the stored revision, replacing any stale expansion
+                valueset_cache.invalidate(data["url"])
+                stored = response.json()
+                if stored.get("resourceType") != ValueSet.RESOURCE_TYPE:
+                    stored = data
+                valueset_cache.add(stored)
+
+
+def serialized_valuesets():
+    """Generate ValueSet (JSON) data from `.json` files in `serialized` directory"""
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    for fname in os.scandir(base_dir):
+        if not fname.name.lower().endswith(".json"):
+            continue
+        with open(fname.path) as fhir:
+            data = json.load(fhir)
+        if data.get("resourceType") == ValueSet.RESOURCE_TYPE:
+            yield data
@@ -1,19 +1,84 @@
 import click
 from collections import defaultdict
 from datetime import datetime
-from flask import Blueprint, abort, current_app, jsonify
+from flask import (
+    Blueprint,
+    Response,
+    abort,
+    current_app,
+    jsonify,
+    request,
+    stream_with_context,
+    url_for,
+)
 from flask.json import JSONEncoder
+import hmac
+from itertools import islice
 import json
 from operator import itemgetter
+from threading import Lock
 import timeit
-
-from carl.logic.copd import classify_for_COPD, remove_COPD_classification
-from carl.logic.diabetes import classify_for_diabetes, remove_diabetes_classification
-from carl.modules.patient import CNICS_IDENTIFIER_SYSTEM
+from urllib.parse import parse_qs
+
+from carl.engine import (
+    ClassificationQueue,
+    matched,
+    process_patient,
+    run_patients,
+    shard_patients,
+)
+from carl.logic.copd import (
+    CNICS_COPD_coding,
+    CNICS_COPD_medication_coding,
+    classify_for_COPD,
+    remove_COPD_classification,
+)
+from carl.logic.diabetes import (
+    CNICS_diabetes_coding,
+    classify_for_diabetes,
+    remove_diabetes_classification,
+)
+from carl.modules.batch import BatchWriter
+from carl.modules.bulkexport import (
+    directory_resources,
+    export_resources,
+    index_by_patient,
+    kick_off_export,
+    poll_export,
+)
+from carl.modules.checkpoint import Checkpoint, CheckpointMismatch
+from carl.modules.condition import MarkerIndex
+from carl.modules.fhirclient import fhir_client
+from carl.modules.patient import CNICS_IDENTIFIER_SYSTEM, existence_stats
 from carl.modules.paging import next_resource_bundle
+from carl.modules.prefetch import CLINICAL_REVINCLUDES, prefetched_patients
+from carl.modules.rules import criterion_stats, enabled_rules
+from carl.modules.spool import spool_search_ids
+from carl.modules.summary import merge_summaries, write_summary
+from carl.modules.subscription import (
+    NOTIFY_TYPES,
+    fetch_resource,
+    notification_subjects,
+)
+from carl.modules.valueset import valueset_cache
+from carl.modules.watermark import (
+    ALL_SITES,
+    clear_watermarks,
+    load_watermark,
+    save_watermark,
+    server_time,
+    updated_subjects,
+)
 
 base_blueprint = Blueprint("base", __name__, cli_group=None)
 
+# Codings of the Conditions persisted to mark classified patients
+MARKER_CODINGS = (
+    CNICS_COPD_coding,
+    CNICS_COPD_medication_coding,
+    CNICS_diabetes_coding,
+)
+
 
 @base_blueprint.cli.command("bootstrap")
 def bootstrap():
@@ -42,13 +107,13 @@ def config_settings(config_key):
     current_app.json_encoder = CustomJSONEncoder
 
     # return selective keys - not all can be be viewed by users, e.g.secret key
-    blacklist = ("SECRET", "KEY")
+    blacklist = ("SECRET", "KEY", "TOKEN")
 
     if config_key:
         key = config_key.upper()
         for pattern in blacklist:
             if pattern in key:
-                abort(status_code=400, messag=f"Configuration key {key} not available")
+                abort(400, description=f"Configuration key {key} not available")
         return jsonify({key: current_app.config.get(key)})
 
     settings = {}
@@ -63,43 +128,323 @@ def config_settings(config_key):
 
 @base_blueprint.route("/classify/<int:patient_id>", methods=["PUT"])
 def classify(patient_id):
-    """Classify single patient as configured"""
-    results = classify_for_COPD(patient_id)
-    results.update(classify_for_diabetes(patient_id))
-    return results
+    """Classify single patient as configured
+
+    The patient is queued for classification in the background; responds
+    `202 Accepted` with the job, its status available at the `Location` given.
+    Pass `?sync=true` to instead classify within the request, responding with
+    the results.
+    """
+    if request.args.get("sync", "").lower() in ("1", "true", "yes"):
+        return process_patient(patient_id, (classify_for_COPD, classify_for_diabetes))
+
+    # queued by string id, as when notified via Subscription
+    job = classification_queue().put(str(patient_id))
+    location = url_for("base.classify_job", job_id=job.id)
+    return jsonify(job.as_json()), 202, {"Location": location}
+
+
+@base_blueprint.route("/classify/jobs/<job_id>")
+def classify_job(job_id):
+    """Report status of a queued classification, with results once finished"""
+    job = classification_queue().job(job_id)
+    if job is None:
+        abort(404, description=f"Job {job_id} not found")
+    return jsonify(job.as_json())
+
+
+_queue_lock = Lock()
+
+
+def classification_queue():
+    """Return the current app's queue for asynchronous classification"""
+    with _queue_lock:
+        if "classify_queue" not in current_app.extensions:
+            current_app.extensions["classify_queue"] = ClassificationQueue(
+                current_app._get_current_object(),
+                (classify_for_COPD, classify_for_diabetes),
+                workers=current_app.config["CLASSIFY_QUEUE_WORKERS"],
+                debounce=current_app.config["CLASSIFY_DEBOUNCE_SECONDS"],
+            )
+        return current_app.extensions["classify_queue"]
+
+
+@base_blueprint.route("/queue")
+def queue_stats():
+    """Report asynchronous classification queue depth, lag and counters"""
+    return jsonify(classification_queue().stats())
+
+
+@base_blueprint.route("/subscription/notify", methods=["POST"])
+@base_blueprint.route(
+    "/subscription/notify/<resource_type>/<resource_id>", methods=["POST", "PUT"]
+)
+def subscription_notify(resource_type=None, resource_id=None):
+    """Receive FHIR Subscription REST hook notification, queue its subjects
+
+    Notifications may carry the changed resource, a Bundle of resources, or
+    (without payload) name the changed resource in the url, appended to the
+    Subscription `channel.endpoint`.
+    """
+    token = current_app.config["SUBSCRIPTION_TOKEN"]
+    authorization = request.headers.get("Authorization", "")
+    if token and not hmac.compare_digest(authorization, f"Bearer {token}"):
+        abort(401)
+
+    payload = request.get_json(force=True, silent=True)
+    if not payload and resource_type in NOTIFY_TYPES:
+        payload = fetch_resource(resource_type, resource_id)
+
+    patient_ids = sorted(notification_subjects(payload, MARKER_CODINGS))
+    queue = classification_queue()
+    for patient_id in patient_ids:
+        queue.put(patient_id)
+    return jsonify(queued=patient_ids), 202
+
+
+@base_blueprint.route("/classify", methods=["POST"])
+def classify_many():
+    """Classify many patients, streaming results as NDJSON as each finishes
+
+    Request body names the patients, as one of:
+
+    - `{"patient_ids": [...]}`
+    - `{"site": "uw"}`, for all patients of a site
+    - `{"search": "identifier=..."}`, any Patient search query string
+
+    Pages of patients are prefetched along with their clinical resources, and
+    classified concurrently by CLASSIFY_WORKERS.  Each line of the response
+    holds one patient's `patient_id`, `results` and `error`; given ids not
+    found are reported as errors.
+    """
+    body = request.get_json(force=True, silent=True) or {}
+    patient_ids = body.get("patient_ids")
+    if patient_ids is not None:
+        if not isinstance(patient_ids, list):
+            abort(400, description="patient_ids must be a list")
+        patient_ids = [str(patient_id) for patient_id in patient_ids]
+        patients = prefetched_by_id(patient_ids, CLINICAL_REVINCLUDES)
+    elif body.get("site"):
+        search_params = {"identifier": f"{CNICS_IDENTIFIER_SYSTEM}{body['site']}|"}
+        patients = prefetched_patients(search_params, CLINICAL_REVINCLUDES)
+    elif body.get("search"):
+        search_params = parse_qs(body["search"].lstrip("?"))
+        patients = prefetched_patients(search_params, CLINICAL_REVINCLUDES)
+    else:
+        abort(400, description="Require one of patient_ids, site or search")
+
+    workers = current_app.config["CLASSIFY_WORKERS"]
+    fhir_client().ensure_pool(workers)
+
+    def generate():
+        found = set()
+        for patient_id, results, error in run_patients(
+            patients, (classify_for_COPD, classify_for_diabetes), workers=workers
+        ):
+            found.add(patient_id)
+            line = {
+                "patient_id": patient_id,
+                "results": results,
+                "error": str(error) if error else None,
+            }
+            yield json.dumps(line) + "\n"
+        for patient_id in patient_ids or ():
+            if patient_id not in found:
+                line = {"patient_id": patient_id, "error": "Patient not found"}
+                yield json.dumps(line) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
+def workers_option(f):
+    """Decorator adding the `--workers` option to a CLI command"""
+    return click.option(
+        "--workers",
+        "-w",
+        type=click.IntRange(min=1),
+        default=None,
+        help="Number of patients to process concurrently; default CLASSIFY_WORKERS",
+    )(f)
+
+
+def prefetch_option(f):
+    """Decorator adding the `--prefetch` flag to a CLI command"""
+    return click.option(
+        "--prefetch",
+        is_flag=True,
+        help="Fetch pages of Patients along with their resources via _revinclude",
+    )(f)
+
+
+def batch_option(f):
+    """Decorator adding the `--batch-size` option to a CLI command"""
+    return click.option(
+        "--batch-size",
+        type=click.IntRange(min=1),
+        default=None,
+        help="Queue marker Condition writes, sending batch Bundles of this size",
+    )(f)
+
+
+def checkpoint_options(f):
+    """Decorator adding the `--checkpoint` and `--resume` options to a CLI command"""
+    f = click.option(
+        "--resume",
+        is_flag=True,
+        help="Skip patients completed by an interrupted run, per its checkpoint",
+    )(f)
+    return click.option(
+        "--checkpoint",
+        type=click.Path(dir_okay=False),
+        default=None,
+        help="Checkpoint file of completed patients; default CLASSIFY_CHECKPOINT_FILE",
+    )(f)
+
+
+class ShardType(click.ParamType):
+    """Shard given as `i/N`, the zero based index of N shards"""
+
+    name = "shard"
+
+    def convert(self, value, param, ctx):
+        if isinstance(value, tuple):
+            return value
+        try:
+            index, count = (int(part) for part in value.split("/"))
+        except ValueError:
+            self.fail(f"{value} not of form i/N", param, ctx)
+        if not 0 <= index < count:
+            self.fail(f"{value} requires 0 <= i < N", param, ctx)
+        return index, count
+
+
+def shard_options(f):
+    """Decorator adding the `--shard` and `--summary` options to a CLI command"""
+    f = click.option(
+        "--summary",
+        type=click.Path(dir_okay=False, writable=True),
+        default=None,
+        help="Also write summary as JSON to given file, i.e. for merge-summaries",
+    )(f)
+    return click.option(
+        "--shard",
+        type=ShardType(),
+        default=None,
+        help="Process only shard i of N (zero based), partitioned by Patient id",
+    )(f)
 
 
 @base_blueprint.cli.command("classify")
 @click.argument("site", nargs=-1)
-def classify_all(site):
-    """Classify all patients found"""
+@workers_option
+@prefetch_option
+@batch_option
+@checkpoint_options
+@shard_options
+@click.option(
+    "--full",
+    is_flag=True,
+    help="Classify all patients, rather than those updated since the last run",
+)
+def classify_all(
+    site, workers, prefetch, batch_size, checkpoint, resume, shard, summary, full
+):
+    """Classify all patients found
+
+    Given a CLASSIFY_WATERMARK_FILE, only patients with clinical resources
+    updated since the last run are classified, unless `--full` is given.
+    """
     return process_patients(
         process_functions=(classify_for_COPD, classify_for_diabetes),
-        site=site,
+        site=site[0] if site else None,
+        workers=workers,
+        revincludes=CLINICAL_REVINCLUDES if prefetch else None,
+        batch_size=batch_size,
+        watermark=current_app.config["CLASSIFY_WATERMARK_FILE"],
+        full=full,
+        checkpoint=checkpoint or current_app.config["CLASSIFY_CHECKPOINT_FILE"],
+        resume=resume,
+        shard=shard,
+        summary_file=summary,
     )
 
 
 @base_blueprint.cli.command("declassify")
 @click.argument("site", nargs=-1)
-def declassify_all(site):
+@workers_option
+@prefetch_option
+@batch_option
+@checkpoint_options
+@shard_options
+def declassify_all(
+    site, workers, prefetch, batch_size, checkpoint, resume, shard, summary
+):
     """Clear the (potentially) persisted conditions generated during classify"""
+    # patients are no longer classified, regardless of when last updated
+    clear_watermarks(current_app.config["CLASSIFY_WATERMARK_FILE"])
     return process_patients(
-        (remove_COPD_classification, remove_diabetes_classification), site
+        (remove_COPD_classification, remove_diabetes_classification),
+        site[0] if site else None,
+        workers=workers,
+        revincludes=("Condition:subject",) if prefetch else None,
+        batch_size=batch_size,
+        checkpoint=checkpoint or current_app.config["CLASSIFY_CHECKPOINT_FILE"],
+        resume=resume,
+        shard=shard,
+        summary_file=summary,
     )
 
 
-def process_patients(process_functions, site):
+def process_patients(
+    process_functions,
+    site,
+    workers=None,
+    revincludes=None,
+    batch_size=None,
+    watermark=None,
+    full=False,
+    checkpoint=None,
+    resume=False,
+    shard=None,
+    summary_file=None,
+):
     """
     Process all patients for given site, with given list of functions.
 
     :param process_functions: ordered list of functions to call on each respective patient
     :param site: name of site being processed, i.e. "uw", or None for all sites
+    :param workers: number of patients to process concurrently, defaults to
+      configured CLASSIFY_WORKERS
+    :param revincludes: optional `_revinclude` values, to fetch each page of
+      Patients along with the named resources, rather than searching each
+      resource type per patient
+    :param batch_size: if given, writes are queued and sent as FHIR batch
+      Bundles of this size, rather than one request per write
+    :param watermark: optional path of file persisting high-water marks; the
+      mark is advanced on completion, should no patient fail
+    :param full: process all patients, rather than only those with resources
+      updated since the persisted watermark
+    :param checkpoint: optional path of file recording completed patients;
+      removed once the run completes without failures
+    :param resume: skip patients completed according to `checkpoint`
+    :param shard: optional (index, count) pair, to process only the patients
+      in the given shard (see `carl.engine.in_shard`); watermark and
+      checkpoint are then kept per shard
+    :param summary_file: optional path to also write the summary as JSON
     """
     start = timeit.default_timer()
+    if resume and not checkpoint:
+        raise click.UsageError("--resume requires a checkpoint file")
+    workers = workers or current_app.config["CLASSIFY_WORKERS"]
+    fhir_client().ensure_pool(workers)
+    # summary reports this run's statistics alone
+    existence_stats.reset()
+    criterion_stats.reset()
     # Obtain batches of Patients (with site identifier if requested),
     # process each in turn
     processed_patients = 0
     matched_patients = 0
+    failed_patients = 0
     search_params = {"_count": 512}  # reduce round trips
     patient_identifier_system = None
     if site:
@@ -108,33 +453,289 @@ def process_patients(process_functions, site):
         # trailing '|' used customarily to delimit `system|value`
         search_params = {"identifier": patient_identifier_system + "|"}
 
-    # cache entries and then process.  necessary as the HAPI paging system
-    # can time out before classification completes.
-    entries = []
-    for bundle in next_resource_bundle("Patient", search_params=search_params):
-        assert bundle["resourceType"] == "Bundle"
-        entries.extend(bundle.get("entry", []))
-
-    for item in entries:
-        assert item["resource"]["resourceType"] == "Patient"
-        results = dict()
-        for process_function in process_functions:
-            results.update(process_function(item["resource"]["id"]))
+    # shards of a run each keep their own watermark and checkpoint
+    watermark_key = site
+    if shard:
+        watermark_key = f"{site or ALL_SITES}:{shard[0]}/{shard[1]}"
+        if checkpoint:
+            checkpoint = f"{checkpoint}.{shard[0]}-of-{shard[1]}"
+
+    since = None if full else load_watermark(watermark, watermark_key)
+    run_started = server_time() if watermark else None
+    spool = None
+    if since:
+        subject_params = {}
+        if site:
+            subject_params["subject:Patient.identifier"] = search_params["identifier"]
+        patient_ids = sorted(updated_subjects(since, subject_params, MARKER_CODINGS))
+        if shard:
+            patient_ids = list(shard_patients(patient_ids, shard))
+        patients = patient_ids
+        if revincludes:
+            patients = prefetched_by_id(patient_ids, revincludes)
+    elif revincludes and shard:
+        # spool ids alone, so only this shard's patients are fetched along
+        # with their resources, rather than those of the whole population
+        spool = spool_search_ids(
+            current_app._get_current_object(), "Patient", search_params
+        )
+        patients = prefetched_by_id(shard_patients(spool, shard), revincludes)
+    elif revincludes:
+        # pages are consumed as patients are processed; with resources
+        # preloaded, processing is quick enough to outpace HAPI paging timeouts
+        patients = prefetched_patients(search_params, revincludes)
+    else:
+        # ids are paged into a spool in the background, as the HAPI paging
+        # system can time out before classification completes
+        spool = spool_search_ids(
+            current_app._get_current_object(), "Patient", search_params
+        )
+        patients = spool
+    if shard and not (since or revincludes):
+        patients = shard_patients(patients, shard)
+
+    # one search per marker code, so unchanged markers aren't rewritten
+    markers = MarkerIndex()
+    for coding in MARKER_CODINGS:
+        markers.load(coding)
+
+    resumed_patients = 0
+    if checkpoint:
+        header = {
+            "functions": [f.__name__ for f in process_functions],
+            "site": site,
+            "shard": list(shard) if shard else None,
+        }
+        try:
+            checkpoint = Checkpoint(checkpoint, header, resume=resume)
+        except CheckpointMismatch as error:
+            raise click.UsageError(str(error))
+        resumed_patients = checkpoint.position
+        patients = checkpoint.skip(patients)
+
+    writer = BatchWriter(batch_size=batch_size) if batch_size else None
+    errored = set()
+    for patient_id, results, error in run_patients(
+        patients, process_functions, workers=workers, writer=writer, markers=markers
+    ):
+        if error:
+            failed_patients += 1
+            errored.add(patient_id)
+            continue
         processed_patients += 1
-        if any(key.endswith("matched") for key in results.keys()):
+        if matched(results):
             matched_patients += 1
+        if checkpoint:
+            checkpoint.done(patient_id)
+            if checkpoint.due():
+                # only record patients once their queued writes succeeded
+                if writer:
+                    writer.flush()
+                    checkpoint.discard(writer.failed_patients)
+                checkpoint.commit()
+    if writer:
+        writer.flush()
+        # patients whose writes failed count as failed, retried on resume
+        write_failed = len(writer.failed_patients - errored)
+        processed_patients -= write_failed
+        failed_patients += write_failed
+        if checkpoint:
+            checkpoint.discard(writer.failed_patients)
+    if checkpoint:
+        checkpoint.close(remove=not failed_patients)
+
+    write_failures = writer.failures if writer else 0
+    if watermark and (failed_patients or write_failures):
+        current_app.logger.warning(
+            f"{failed_patients} patients and {write_failures} writes failed,"
+            f" not advancing watermark {since}"
+        )
+    elif watermark:
+        save_watermark(watermark, run_started, watermark_key)
+
+    duration = timeit.default_timer() - start
+    summary = {
+        "duration": f"{duration:.4f} seconds",
+        "patient_identifier_system": patient_identifier_system,
+        "processed_patients": processed_patients,
+        "matched_patients": matched_patients,
+        "failed_patients": failed_patients,
+        "workers": workers,
+        "incremental_since": since,
+        "resumed_patients": resumed_patients,
+        "entry count:": (
+            spool.count if spool else processed_patients + failed_patients
+        ),
+    }
+    summary.update(markers.stats())
+    if writer:
+        summary.update(writer.stats())
+    summary.update(valueset_cache.stats())
+    summary.update(fhir_client().stats())
+    summary.update(existence_stats.stats())
+    summary.update(criterion_stats.stats())
+    if shard:
+        summary["shard"] = f"{shard[0]}/{shard[1]}"
+    if summary_file:
+        write_summary(summary_file, summary)
+    click.echo(summary)
+
+
+def prefetched_by_id(patient_ids, revincludes):
+    """Generate prefetched `PatientContext`s for given Patient ids, a page at a time
+
+    :param patient_ids: iterable of ids, consumed a page at a time, i.e. a spool
+    """
+    page_size = current_app.config["PREFETCH_PAGE_SIZE"]
+    patient_ids = iter(patient_ids)
+    while True:
+        page = list(islice(patient_ids, page_size))
+        if not page:
+            return
+        yield from prefetched_patients({"_id": ",".join(page)}, revincludes)
+
+
+@base_blueprint.cli.command("enqueue")
+@click.argument("patient_ids", nargs=-1)
+@click.option(
+    "--debounce",
+    type=click.FloatRange(min=0),
+    default=None,
+    help="Seconds to coalesce repeat requests; default CLASSIFY_DEBOUNCE_SECONDS",
+)
+@workers_option
+def enqueue(patient_ids, debounce, workers):
+    """Classify given Patient ids, or those read a line at a time from stdin
+
+    Ids are fed through the debounced classification queue as they arrive,
+    so repeats (i.e. from a feed of changed resources) are coalesced.
+    """
+    start = timeit.default_timer()
+    queue = ClassificationQueue(
+        current_app._get_current_object(),
+        (classify_for_COPD, classify_for_diabetes),
+        workers=workers or current_app.config["CLASSIFY_QUEUE_WORKERS"],
+        debounce=(
+            current_app.config["CLASSIFY_DEBOUNCE_SECONDS"]
+            if debounce is None
+            else debounce
+        ),
+    )
+    fhir_client().ensure_pool(queue.workers)
+    lines = patient_ids or (line.strip() for line in click.get_text_stream("stdin"))
+    for patient_id in lines:
+        if patient_id:
+            queue.put(patient_id)
+    queue.join()
 
     duration = timeit.default_timer() - start
+    summary = {"duration": f"{duration:.4f} seconds", "workers": queue.workers}
+    summary.update(queue.stats())
+    summary.update(fhir_client().stats())
+    click.echo(summary)
+
+
+@base_blueprint.cli.command("merge-summaries")
+@click.argument("summary_files", nargs=-1, required=True, type=click.File())
+def merge_summaries_command(summary_files):
+    """Merge JSON summaries written by shards of a run, i.e. via `--summary`"""
     click.echo(
-        {
-            "duration": f"{duration:.4f} seconds",
-            "patient_identifier_system": patient_identifier_system,
-            "processed_patients": processed_patients,
-            "matched_patients": matched_patients,
-            "entry count:": len(entries),
-        }
+        json.dumps(
+            merge_summaries(
+                [json.load(summary_file) for summary_file in summary_files]
+            ),
+            indent=2,
+        )
+    )
+
+
+@base_blueprint.cli.command("rules")
+def rules_command():
+    """Show the enabled classification rules, and the searches they compile to"""
+    click.echo(
+        json.dumps(
+            {
+                "rules": [rule.marker.code for rule in enabled_rules.rules],
+                "plan": enabled_rules.plan().describe(),
+            },
+            indent=2,
+        )
+    )
+
+
+@base_blueprint.cli.command("export-classify")
+@click.option(
+    "--source",
+    type=click.Path(exists=True, file_okay=False),
+    help="Directory of NDJSON files to classify, rather than $export from FHIR store",
+)
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Marker Conditions per batch Bundle written; default BATCH_WRITE_SIZE",
+)
+@click.option("--dry-run", is_flag=True, help="Classify without writing results")
+@workers_option
+def export_classify(source, batch_size, dry_run, workers):
+    """Classify whole population in memory, from a Bulk Data $export"""
+    from carl.serialized.upload import serialized_valuesets
+
+    start = timeit.default_timer()
+    workers = workers or current_app.config["CLASSIFY_WORKERS"]
+    criterion_stats.reset()
+    if source:
+        # offline; expand ValueSets from the serialized definitions
+        for value_set in serialized_valuesets():
+            valueset_cache.add(value_set)
+        resources = directory_resources(source)
+    else:
+        status_url = kick_off_export()
+        current_app.logger.info(f"$export started, polling {status_url}")
+        resources = export_resources(poll_export(status_url))
+
+    contexts = index_by_patient(resources)
+    writer = BatchWriter(
+        batch_size=batch_size or current_app.config["BATCH_WRITE_SIZE"],
+        dry_run=dry_run,
     )
 
+    # exported Conditions include existing markers; counts only, no search
+    markers = MarkerIndex()
+
+    processed_patients = matched_patients = failed_patients = 0
+    for patient_id, results, error in run_patients(
+        contexts.values(),
+        (classify_for_COPD, classify_for_diabetes),
+        workers=workers,
+        writer=writer,
+        markers=markers,
+    ):
+        if error:
+            failed_patients += 1
+            continue
+        processed_patients += 1
+        if matched(results):
+            matched_patients += 1
+    writer.flush()
+
+    duration = timeit.default_timer() - start
+    summary = {
+        "duration": f"{duration:.4f} seconds",
+        "source": source or "$export",
+        "processed_patients": processed_patients,
+        "matched_patients": matched_patients,
+        "failed_patients": failed_patients,
+        "workers": workers,
+        "dry_run": dry_run,
+    }
+    summary.update(markers.stats())
+    summary.update(writer.stats())
+    summary.update(valueset_cache.stats())
+    summary.update(fhir_client().stats())
+    summary.update(criterion_stats.stats())
+    click.echo(summary)
+
 
 @base_blueprint.cli.command("valueset")
 @click.argument("resource_type")
@@ -0,0 +1,10 @@
+from pytest import fixture
+
+from carl.app import create_app
+
+
+@fixture
+def app_context():
+    app = create_app(testing=True)
+    with app.app_context():
+        yield app
@@ -0,0 +1,409 @@
+import json
+from pytest import fixture
+from requests.exceptions import HTTPError
+
+from carl.engine import (
+    ClassificationQueue,
+    in_shard,
+    matched,
+    process_patient,
+    run_patients,
+    shard_patients,
+)
+from carl.logic.copd import (
+    CNICS_COPD_coding,
+    CNICS_COPD_medication_coding,
+    classify_for_COPD,
+)
+from carl.logic.diabetes import CNICS_diabetes_coding, classify_for_diabetes
+from carl.modules.batch import BatchWriter
+from carl.modules.bulkexport import directory_resources, index_by_patient, ndjson_lines
+from carl.modules.condition import MarkerIndex, mark_patient_with_condition
+from carl.modules.patient import PatientContext
+from carl.modules.prefetch import subject_id
+from carl.modules.rules import criterion_stats
+from carl.modules.spool import IdSpool
+from carl.modules.valueset import valueset_cache
+from carl.serialized.upload import serialized_valuesets
+from carl.views import process_patients
+
+
+def tag_even(patient_id, context=None):
+    if patient_id % 2:
+        return {"patient_id": patient_id}
+    return {"patient_id": patient_id, "even_matched": True}
+
+
+def fail_on_seven(patient_id, context=None):
+    if patient_id == 7:
+        raise ValueError("bad record")
+    return {}
+
+
+def test_process_patient():
+    results = process_patient(4, (tag_even, fail_on_seven))
+    assert matched(results)
+    assert not matched(process_patient(3, (tag_even,)))
+
+
+def test_run_patients_sequential(app_context):
+    outcomes = list(run_patients(range(10), (tag_even, fail_on_seven)))
+    assert [o[0] for o in outcomes] == list(range(10))
+    assert sum(1 for _, results, _ in outcomes if results and matched(results)) == 5
+
+
+def test_run_patients_concurrent(app_context):
+    outcomes = list(run_patients(range(100), (fail_on_seven, tag_even), workers=4))
+    assert sorted(o[0] for o in outcomes) == list(range(100))
+
+    failed = [(patient_id, error) for patient_id, _, error in outcomes if error]
+    assert len(failed) == 1
+    assert failed[0][0] == 7
+    assert isinstance(failed[0][1], ValueError)
+
+
+def test_shards():
+    patient_ids = [str(i) for i in range(1000)]
+    shards = [list(shard_patients(patient_ids, (i, 4))) for i in range(4)]
+    # every patient in exactly one shard, roughly evenly
+    assert sorted(sum(shards, [])) == sorted(patient_ids)
+    assert all(200 < len(shard) < 300 for shard in shards)
+    assert in_shard(7, (0, 1))
+
+
+def test_merge_summaries(app_context, tmp_path):
+    summaries = [
+        {
+            "duration": f"{2.5 + i:.4f} seconds",
+            "processed_patients": 10,
+            "site": "uw",
+            "shard": f"{i}/2",
+            "fhir_requests_by_method": {"GET": 20, "PUT": i},
+        }
+        for i in range(2)
+    ]
+    paths = []
+    for i, summary in enumerate(summaries):
+        paths.append(str(tmp_path / f"summary-{i}.json"))
+        with open(paths[-1], "w") as summary_file:
+            json.dump(summary, summary_file)
+
+    runner = app_context.test_cli_runner()
+    result = runner.invoke(args=["merge-summaries"] + paths)
+    assert result.exit_code == 0
+    assert json.loads(result.output) == {
+        "shards": 2,
+        "duration": "3.5000 seconds",
+        "processed_patients": 20,
+        "site": "uw",
+        "shard": ["0/2", "1/2"],
+        "fhir_requests_by_method": {"GET": 40, "PUT": 1},
+    }
+
+    result = runner.invoke(args=["classify", "--shard", "2/2"])
+    assert result.exit_code == 2
+    assert "0 <= i < N" in result.output
+
+
+def test_classification_queue(app_context):
+    processed = []
+
+    def record(patient_id, context=None):
+        processed.append(patient_id)
+        return {}
+
+    queue = ClassificationQueue(app_context, (fail_on_seven, record))
+    for patient_id in (7, 1, 2):
+        queue.put(patient_id)
+    queue.join()
+    # failure on 7 doesn't halt the queue
+    assert processed == [1, 2]
+    assert queue.stats()["queue_failed"] == 1
+
+
+def test_classification_queue_debounce(app_context):
+    processed = []
+
+    def record(patient_id, context=None):
+        processed.append(patient_id)
+        return {}
+
+    queue = ClassificationQueue(app_context, (record,), workers=2, debounce=0.2)
+    for patient_id in (1, 2, 1, 1, 2):
+        queue.put(patient_id)
+    assert queue.depth() == 2
+    queue.join()
+
+    assert sorted(processed) == [1, 2]
+    stats = queue.stats()
+    assert stats["queue_requested"] == 5
+    assert stats["queue_coalesced"] == 3
+    assert stats["queue_processed"] == 2
+    assert stats["queue_depth"] == 0
+    assert stats["queue_max_lag_seconds"] >= 0.2
+
+
+def test_subscription_notify(app_context, mocker, datadir):
+    mock_put = mocker.patch("carl.engine.ClassificationQueue.put")
+    with open(datadir / "export" / "Condition.ndjson") as conditions:
+        bundle = {
+            "resourceType": "Bundle",
+            "type": "history",
+            "entry": [{"resource": r} for r in ndjson_lines(conditions)],
+        }
+    response = app_context.test_client().post("/subscription/notify", json=bundle)
+    assert response.status_code == 202
+    # marker Conditions don't trigger classification
+    assert response.get_json() == {"queued": ["1", "3"]}
+    assert mock_put.call_count == 2
+
+
+def test_subscription_token(app_context, mocker):
+    mock_put = mocker.patch("carl.engine.ClassificationQueue.put")
+    app_context.config["SUBSCRIPTION_TOKEN"] = "s3cr3t"
+    client = app_context.test_client()
+    bundle = {"resourceType": "Bundle", "type": "history", "entry": []}
+
+    response = client.post("/subscription/notify", json=bundle)
+    assert response.status_code == 401
+    response = client.post(
+        "/subscription/notify",
+        json=bundle,
+        headers={"Authorization": "Bearer guess"},
+    )
+    assert response.status_code == 401
+    response = client.post(
+        "/subscription/notify",
+        json=bundle,
+        headers={"Authorization": "Bearer s3cr3t"},
+    )
+    assert response.status_code == 202
+    assert not mock_put.called
+
+    # never revealed by settings
+    assert "SUBSCRIPTION_TOKEN" not in client.get("/settings").get_json()
+    assert client.get("/settings/subscription_token").status_code == 400
+
+
+def test_classify_async(app_context, mocker):
+    def tag_even_id(patient_id, context=None):
+        return tag_even(int(patient_id))
+
+    queue = ClassificationQueue(app_context, (tag_even_id,))
+    app_context.extensions["classify_queue"] = queue
+    client = app_context.test_client()
+
+    response = client.put("/classify/4")
+    assert response.status_code == 202
+    assert response.get_json()["status"] in ("queued", "running")
+    queue.join()
+    job = client.get(response.headers["Location"]).get_json()
+    assert job["status"] == "done"
+    assert job["results"]["even_matched"]
+
+    assert client.get("/classify/jobs/unknown").status_code == 404
+
+    mocker.patch("carl.views.process_patient", return_value={"patient_id": 5})
+    response = client.put("/classify/5?sync=true")
+    assert response.status_code == 200
+    assert response.get_json() == {"patient_id": 5}
+
+
+@fixture
+def serialized_valueset_cache():
+    valueset_cache.invalidate()
+    for value_set in serialized_valuesets():
+        valueset_cache.add(value_set)
+    yield valueset_cache
+    valueset_cache.invalidate()
+
+
+def test_export_classify_in_memory(
+    app_context, datadir, mocker, serialized_valueset_cache
+):
+    mock_request = mocker.patch("carl.modules.fhirclient.FhirClient.request")
+    contexts = index_by_patient(directory_resources(datadir / "export"))
+    assert sorted(contexts) == ["1", "2", "3"]
+
+    writer = BatchWriter(batch_size=10, dry_run=True)
+    markers = MarkerIndex()
+    outcomes = {
+        patient_id: results
+        for patient_id, results, error in run_patients(
+            contexts.values(),
+            (classify_for_COPD, classify_for_diabetes),
+            workers=2,
+            writer=writer,
+            markers=markers,
+        )
+    }
+
+    assert f"{CNICS_COPD_coding.code}_matched" in outcomes["1"]
+    assert f"{CNICS_COPD_medication_coding.code}_matched" in outcomes["1"]
+    assert f"{CNICS_diabetes_coding.code}_matched" in outcomes["2"]
+    assert not matched(outcomes["3"])
+
+    writer.flush()
+    # existing COPD marker on 1 is left be, stale diabetes marker on 3 removed
+    assert markers.stats() == {
+        "marker_created": 2,
+        "marker_updated": 0,
+        "marker_unchanged": 1,
+        "marker_removed": 1,
+    }
+    assert writer.stats()["batch_writes"] == 3
+    # classified entirely in memory
+    assert mock_request.call_count == 0
+
+
+def test_classify_many(app_context, datadir, mocker, serialized_valueset_cache):
+    resources = list(directory_resources(datadir / "export"))
+    capabilities = {
+        "rest": [{"resource": [{"type": "Patient", "searchRevInclude": ["*"]}]}]
+    }
+
+    def ok(data):
+        return mocker.Mock(status_code=200, **{"json.return_value": data})
+
+    def search(path, params=None, **kwargs):
+        if path == "metadata":
+            return ok(capabilities)
+        # one page of matched Patients, along with their _revinclude resources
+        assert path == "Patient" and params["_revinclude"]
+        ids = params["_id"].split(",")
+        entries = [
+            {"resource": resource, "search": {"mode": "match"}}
+            for resource in resources
+            if resource["resourceType"] == "Patient" and resource["id"] in ids
+        ] + [
+            {"resource": resource, "search": {"mode": "include"}}
+            for resource in resources
+            if subject_id(resource) in ids
+        ]
+        return ok({"resourceType": "Bundle", "entry": entries})
+
+    mock_get = mocker.patch(
+        "carl.modules.fhirclient.FhirClient.get", side_effect=search
+    )
+    # marker Conditions written back
+    mocker.patch("carl.modules.fhirclient.FhirClient.put", return_value=ok({}))
+    response = app_context.test_client().post(
+        "/classify", json={"patient_ids": [1, "2", "404"]}
+    )
+    assert response.mimetype == "application/x-ndjson"
+    lines = {
+        line["patient_id"]: line
+        for line in map(json.loads, response.get_data(as_text=True).splitlines())
+    }
+    assert sorted(lines) == ["1", "2", "404"]
+    assert f"{CNICS_COPD_coding.code}_matched" in lines["1"]["results"]
+    assert f"{CNICS_diabetes_coding.code}_matched" in lines["2"]["results"]
+    assert lines["404"]["error"] == "Patient not found"
+    # capabilities, then one page of Patients answering every criterion
+    assert [c.args[0] for c in mock_get.call_args_list] == ["metadata", "Patient"]
+
+    assert app_context.test_client().post("/classify", json={}).status_code == 400
+
+
+def mark_copd(patient_id, context=None):
+    return mark_patient_with_condition(patient_id, CNICS_COPD_coding, {}, context)
+
+
+@fixture
+def failing_batches(app_context, mocker):
+    """Patients 1-3 to process, with every batch write rejected"""
+    spool = IdSpool()
+    spool.extend(["1", "2", "3"])
+    spool.close()
+    mocker.patch("carl.views.spool_search_ids", return_value=spool)
+    mocker.patch("carl.views.server_time", return_value="2026-10-18T00:00:00+00:00")
+    mocker.patch("carl.modules.condition.MarkerIndex.load")
+    return mocker.patch(
+        "carl.modules.fhirclient.FhirClient.post",
+        return_value=mocker.Mock(
+            status_code=500,
+            **{"raise_for_status.side_effect": HTTPError("500 Server Error")},
+        ),
+    )
+
+
+def test_prefetch_shard(app_context, mocker):
+    patient_ids = [str(i) for i in range(1, 9)]
+    spool = IdSpool()
+    spool.extend(patient_ids)
+    spool.close()
+    mock_spool = mocker.patch("carl.views.spool_search_ids", return_value=spool)
+    mocker.patch("carl.modules.condition.MarkerIndex.load")
+    mock_prefetch = mocker.patch(
+        "carl.views.prefetched_patients",
+        side_effect=lambda search_params, revincludes: (
+            PatientContext(patient_id) for patient_id in search_params["_id"].split(",")
+        ),
+    )
+    processed = []
+
+    def record(patient_id, context=None):
+        processed.append(patient_id)
+        return {}
+
+    shard = (1, 3)
+    process_patients((record,), None, revincludes=("Condition:subject",), shard=shard)
+    assert mock_spool.call_count == 1
+    # only the shard's patients are fetched with their resources
+    in_this_shard = [p for p in patient_ids if in_shard(p, shard)]
+    fetched = [
+        patient_id
+        for call in mock_prefetch.call_args_list
+        for patient_id in call[0][0]["_id"].split(",")
+    ]
+    assert fetched == in_this_shard
+    assert sorted(processed) == in_this_shard
+
+
+def test_failed_writes_hold_watermark(failing_batches, tmp_path):
+    watermark = tmp_path / "watermark.json"
+    process_patients((mark_copd,), None, batch_size=2, watermark=str(watermark))
+    assert failing_batches.call_count == 2
+    assert not watermark.exists()
+
+
+def test_failed_writes_not_checkpointed(failing_batches, mocker, tmp_path):
+    checkpoint = tmp_path / "classify.checkpoint"
+    summary = tmp_path / "summary.json"
+    # left over from a previous run in the same process
+    criterion_stats.record("stale", matched=True, round_trips=1)
+    process_patients(
+        (mark_copd,),
+        None,
+        batch_size=2,
+        checkpoint=str(checkpoint),
+        summary_file=str(summary),
+    )
+    report = json.loads(summary.read_text())
+    assert report["failed_patients"] == 3
+    assert report["processed_patients"] == 0
+    assert not report["criteria_evaluated"]
+    # kept, recording no patient as completed
+    assert len(checkpoint.read_text().splitlines()) == 1
+
+    # all retried on resume
+    failing_batches.return_value = mocker.Mock(
+        status_code=200,
+        **{"json.return_value": {"entry": [{"response": {"status": "200 OK"}}] * 2}},
+    )
+    spool = IdSpool()
+    spool.extend(["1", "2", "3"])
+    spool.close()
+    mocker.patch("carl.views.spool_search_ids", return_value=spool)
+    process_patients(
+        (mark_copd,),
+        None,
+        batch_size=2,
+        checkpoint=str(checkpoint),
+        resume=True,
+        summary_file=str(summary),
+    )
+    report = json.loads(summary.read_text())
+    assert report["processed_patients"] == 3
+    assert report["failed_patients"] == 0
+    assert not checkpoint.exists()
@@ -1,21 +1,78 @@
 import json
 import os
+import pytest
 from pytest import fixture
+from requests.exceptions import HTTPError
+from threading import Event, Thread
 from urllib.parse import urlencode
 
 from carl.logic.copd import CNICS_COPD_coding
 from carl.logic.diabetes import A1C_observation_coding
+from carl.modules.batch import BatchWriter
+from carl.modules.checkpoint import COMMIT_SECONDS, Checkpoint, CheckpointMismatch
 from carl.modules.factories import deserialize_resource
+from carl.modules.fhirclient import FhirClient
 from carl.modules.codeableconcept import CodeableConcept
-from carl.modules.coding import Coding
-from carl.modules.condition import Condition
+from carl.modules.coding import (
+    Coding,
+    coding_key,
+    parse_token_list,
+    token_list_param,
+)
+from carl.modules.condition import (
+    Condition,
+    MarkerIndex,
+    mark_patient_with_condition,
+    unmark_patient_with_condition,
+)
 from carl.modules.codesystem import CodeSystem
-from carl.modules.observation import Observation
-from carl.modules.paging import next_page_link_from_bundle, next_resource_bundle
-from carl.modules.patient import Patient, patient_canonical_identifier
+from carl.modules.observation import (
+    Observation,
+    ObservationValues,
+    patient_observations,
+)
+from carl.modules.bundlestream import BundleStream
+from carl.modules.paging import (
+    next_page_link_from_bundle,
+    next_resource_bundle,
+    next_resource_entry,
+)
+from carl.modules.prefetch import (
+    CLINICAL_REVINCLUDES,
+    contexts_from_bundle,
+    subject_id,
+)
+from carl.modules.patient import (
+    Patient,
+    PatientContext,
+    existence_stats,
+    patient_canonical_identifier,
+    patient_has,
+    patient_has_any,
+)
 from carl.modules.reference import Reference
-from carl.modules.valueset import ValueSet, valueset_codings
+from carl.modules.rules import (
+    MIN_SAMPLES,
+    AnyOf,
+    CriterionStats,
+    HasCoding,
+    QueryPlan,
+    Rule,
+    ValueAtLeast,
+    classify,
+    criterion_stats,
+)
+from carl.modules.spool import IdSpool, spool_search_ids
+from carl.modules.valueset import (
+    ValueSet,
+    ValueSetMatcher,
+    valueset_cache,
+    valueset_codings,
+    valueset_keys,
+    valueset_matcher,
+)
 from carl.modules.valuequantity import ValueQuantity
+from carl.modules.watermark import load_watermark, save_watermark, updated_subjects
 
 PATIENT_ID = "def123"
 
@@ -30,6 +87,10 @@ class MockResponse(object):
     def json(self):
         return self.data
 
+    @property
+    def content(self):
+        return json.dumps(self.data).encode()
+
     def raise_for_status(self):
         if self.status_code == 200:
             return
@@ -133,6 +194,28 @@ def diabetes_intvalue_observation():
     return Observation.from_fhir(obs)
 
 
+@fixture
+def condition_bundle():
+    def condition(system, code):
+        return {
+            "resource": {
+                "resourceType": "Condition",
+                "code": {"coding": [{"system": system, "code": code}]},
+                "subject": {"reference": f"Patient/{PATIENT_ID}"},
+            }
+        }
+
+    return {
+        "resourceType": "Bundle",
+        "total": 2,
+        "link": [{"relation": "self", "url": "http://hapi/fhir/Condition"}],
+        "entry": [
+            condition("http://hl7.org/fhir/sid/icd-10-cm", "J44.9"),
+            condition("http://hl7.org/fhir/sid/icd-10-cm", "E11.9"),
+        ],
+    }
+
+
 @fixture
 def patient_data(datadir):
     return load_jsondata(datadir, "patient.json")
@@ -171,10 +254,18 @@ def test_deserialize_valueset(valueset_data):
     assert resource.search_url() == f"ValueSet?{encoded_url}"
 
 
-def test_valueset_codings(mocker, valueset_bundle):
+@fixture
+def empty_valueset_cache():
+    valueset_cache.invalidate()
+    valueset_cache.hits = valueset_cache.misses = 0
+    yield valueset_cache
+    valueset_cache.invalidate()
+
+
+def test_valueset_codings(mocker, valueset_bundle, empty_valueset_cache):
     # fake HAPI round trip call w/i valueset_codings()
     mocker.patch(
-        "carl.modules.valueset.requests.get",
+        "carl.modules.fhirclient.FhirClient.get",
         return_value=MockResponse(data=valueset_bundle),
     )
 
@@ -190,6 +281,63 @@ def test_valueset_codings(mocker, valueset_bundle):
     assert look_for.intersection(codings)
 
 
+def test_valueset_cache(mocker, valueset_bundle, empty_valueset_cache):
+    mock_get = mocker.patch(
+        "carl.modules.fhirclient.FhirClient.get",
+        return_value=MockResponse(data=valueset_bundle),
+    )
+
+    vs_url = "http://cnics-cirg.washington.edu/fhir/ValueSet/CNICS-COPD-codings"
+    first = valueset_codings(vs_url)
+    second = valueset_codings(vs_url)
+    assert isinstance(first, frozenset)
+    assert first is second
+    assert mock_get.call_count == 1
+    stats = empty_valueset_cache.stats()
+    assert stats["valueset_cache_hits"] == 1
+    assert stats["valueset_cache_misses"] == 1
+
+    # explicit invalidation forces another round trip
+    empty_valueset_cache.invalidate(vs_url)
+    assert valueset_codings(vs_url) == first
+    assert mock_get.call_count == 2
+
+
+def test_valueset_cache_revision(valueset_bundle, empty_valueset_cache):
+    value_set = valueset_bundle["entry"][0]["resource"]
+    original = empty_valueset_cache.add(value_set)
+    assert empty_valueset_cache.add(value_set) is original
+
+    # new revision with one less concept generates a fresh expansion
+    revised = json.loads(json.dumps(value_set))
+    revised["meta"]["versionId"] = "4"
+    revised["compose"]["include"][0]["concept"].pop()
+    assert len(empty_valueset_cache.add(revised)) == len(original) - 1
+    assert len(valueset_codings(value_set["url"])) == len(original) - 1
+
+
+def test_fhir_client(requests_mock, patient_data):
+    client = FhirClient(base_url="http://hapi/fhir/", pool_size=4, retries=2)
+    requests_mock.get("http://hapi/fhir/Patient/1", json=patient_data)
+    requests_mock.get("http://other/next-page", json={})
+
+    assert client.get("Patient/1").json() == patient_data
+    assert client.get("http://other/next-page").json() == {}
+    assert "gzip" in requests_mock.request_history[0].headers["Accept-Encoding"]
+
+    stats = client.stats()
+    assert stats["fhir_requests"] == 2
+    assert stats["fhir_requests_by_method"] == {"GET": 2}
+
+    adapter = client.session.get_adapter("http://hapi/fhir/")
+    assert adapter.max_retries.total == 2
+    assert 429 in adapter.max_retries.status_forcelist
+
+    client.ensure_pool(16)
+    assert client.pool_size == 16
+    assert client.session.get_adapter("http://hapi/fhir/")._pool_maxsize == 16
+
+
 def test_COPD_condition_patient(copd_condition):
     assert copd_condition.code == CodeableConcept(CNICS_COPD_coding)
     params = urlencode(
@@ -212,6 +360,111 @@ def test_diabetes_obs_patient(diabetes_observation):
     assert diabetes_observation.search_url() == f"Observation?{params}"
 
 
+def test_batch_writer(mocker, copd_condition):
+    outcomes = [{"status": "201 Created"}, {"status": "412 Precondition Failed"}]
+    mock_post = mocker.patch(
+        "carl.modules.fhirclient.FhirClient.post",
+        return_value=MockResponse(
+            {"resourceType": "Bundle", "entry": [{"response": o} for o in outcomes]}
+        ),
+    )
+    writer = BatchWriter(batch_size=2)
+    results = {}
+    writer.upsert(copd_condition, results, "upsert")
+    assert mock_post.call_count == 0
+    writer.delete(copd_condition, results, "delete")
+    assert mock_post.call_count == 1
+
+    bundle = mock_post.call_args[1]["json"]
+    assert bundle["type"] == "batch"
+    assert [e["request"]["method"] for e in bundle["entry"]] == ["PUT", "DELETE"]
+    assert results == {"upsert": outcomes[0], "delete": outcomes[1]}
+    assert writer.stats() == {
+        "batch_writes": 2,
+        "batch_requests": 1,
+        "batch_failures": 1,
+    }
+
+
+def test_batch_writer_flush_waits(mocker, copd_condition):
+    sending, release = Event(), Event()
+
+    def post(path, json):
+        sending.set()
+        release.wait(5)
+        raise HTTPError("502 Bad Gateway")
+
+    mocker.patch("carl.modules.fhirclient.FhirClient.post", side_effect=post)
+    writer = BatchWriter(batch_size=2)
+    # a worker fills a batch, sending it on behalf of patients 1 and 2
+    worker = Thread(
+        target=lambda: [
+            writer.upsert(copd_condition, patient_id=patient_id)
+            for patient_id in ("1", "2")
+        ]
+    )
+    worker.start()
+    assert sending.wait(5)
+
+    flushed = Thread(target=writer.flush)
+    flushed.start()
+    flushed.join(0.1)
+    # nothing pending, but the batch in flight isn't done
+    assert flushed.is_alive()
+    release.set()
+    flushed.join(5)
+    worker.join(5)
+    assert not flushed.is_alive()
+    assert writer.failed_patients == {"1", "2"}
+
+
+def test_marker_index(app_context, mocker, copd_condition):
+    marker = copd_condition.as_fhir()
+    marker["id"] = "99"
+    mock_get = mocker.patch(
+        "carl.modules.fhirclient.FhirClient.get",
+        return_value=MockResponse(
+            {"resourceType": "Bundle", "entry": [{"resource": marker}]}
+        ),
+    )
+    mock_put = mocker.patch(
+        "carl.modules.fhirclient.FhirClient.put",
+        return_value=MockResponse(marker),
+    )
+    mock_delete = mocker.patch(
+        "carl.modules.fhirclient.FhirClient.delete",
+        return_value=MockResponse({}),
+    )
+    markers = MarkerIndex()
+    markers.load(CNICS_COPD_coding)
+    assert mock_get.call_count == 1
+    assert mock_get.call_args[1]["params"]["_elements"] == "code,subject"
+    assert markers.get(CNICS_COPD_coding, PATIENT_ID)["id"] == "99"
+
+    # marked patient is left be, others are written
+    context = PatientContext(PATIENT_ID, markers=markers)
+    mark_patient_with_condition(PATIENT_ID, CNICS_COPD_coding, {}, context)
+    assert mock_put.call_count == 0
+    context = PatientContext("other", markers=markers)
+    mark_patient_with_condition("other", CNICS_COPD_coding, {}, context)
+    assert mock_put.call_count == 1
+
+    # only known markers are retracted
+    unmark_patient_with_condition(
+        "unmarked", CNICS_COPD_coding, {}, PatientContext("unmarked", markers=markers)
+    )
+    assert mock_delete.call_count == 0
+    context = PatientContext(PATIENT_ID, markers=markers)
+    unmark_patient_with_condition(PATIENT_ID, CNICS_COPD_coding, {}, context)
+    assert mock_delete.call_count == 1
+    assert markers.stats() == {
+        "marker_created": 1,
+        "marker_updated": 0,
+        "marker_unchanged": 1,
+        "marker_removed": 1,
+    }
+
+
 def test_condition_as_fhir(copd_condition):
     fhir = copd_condition.as_fhir()
     assert set(fhir.keys()) == set(("resourceType", "code", "subject"))
@@ -221,7 +474,7 @@ def test_condition_as_fhir(copd_condition):
 def test_paging(mocker, patient_search_bundle):
     # mock first of many page results:
     mocker.patch(
-        "carl.modules.paging.requests.get",
+        "carl.modules.fhirclient.FhirClient.get",
         return_value=MockResponse(data=patient_search_bundle),
     )
 
@@ -234,10 +487,65 @@ def test_paging(mocker, patient_search_bundle):
     assert url.startswith("http://")
 
 
+def chunked(data, size):
+    """Serialize data as JSON, split in chunks of given size"""
+    body = json.dumps(data, indent=1, ensure_ascii=False).encode()
+    chunks = []
+    while body:
+        chunks.append(body[:size])
+        body = body[size:]
+    return chunks
+
+
+def test_bundle_stream(patient_search_bundle):
+    bundle = dict(patient_search_bundle, total=12345)
+    bundle["entry"] = bundle["entry"] + [
+        {"resource": {"resourceType": "Patient", "id": "é", "name": [{"text": "Zoë"}]}}
+    ]
+    # tiny chunks split keys, numbers and multibyte characters alike
+    for size in (1, 3, 64 * 1024):
+        stream = BundleStream(chunked(bundle, size))
+        assert list(stream) == bundle["entry"]
+        assert stream.entries == len(bundle["entry"])
+        assert stream.bundle["total"] == 12345
+        assert next_page_link_from_bundle(stream.bundle) == next_page_link_from_bundle(
+            bundle
+        )
+
+    # numbers cut short after a decimal point or exponent
+    for number in ("6.5", "6e2", "65"):
+        chunks = [f'{{"total": {number[:2]}'.encode(), f"{number[2:]},".encode()]
+        stream = BundleStream(chunks + [b' "entry": []}'])
+        assert not list(stream)
+        assert stream.bundle["total"] == json.loads(number)
+
+    assert not list(BundleStream(chunked({"resourceType": "Bundle", "entry": []}, 5)))
+    with pytest.raises(ValueError):
+        list(BundleStream([b'{"entry": [{"resource": {}}']))
+
+
+def test_next_resource_entry_stream(mocker, patient_search_bundle):
+    last_page = dict(patient_search_bundle, link=[])
+    pages = iter([patient_search_bundle, last_page])
+
+    def get(path, params=None, stream=False):
+        assert stream
+        response = mocker.Mock(status_code=200)
+        response.iter_content.return_value = chunked(next(pages), 100)
+        return response
+
+    mock_get = mocker.patch("carl.modules.fhirclient.FhirClient.get", side_effect=get)
+    entries = list(next_resource_entry("Patient", {"_count": 512}, stream=True))
+    assert entries == patient_search_bundle["entry"] * 2
+    assert mock_get.call_args_list[1][0][0] == next_page_link_from_bundle(
+        patient_search_bundle
+    )
+
+
 def test_canonical_identifier(mocker, patient_data):
     # mock HAPI result from patient lookup
     mocker.patch(
-        "carl.modules.patient.requests.get",
+        "carl.modules.fhirclient.FhirClient.get",
         return_value=MockResponse(data=patient_data),
     )
 
@@ -245,6 +553,361 @@ def test_canonical_identifier(mocker, patient_data):
     assert found == "https://cnics.cirg.washington.edu/site-patient-id/uw|UW:517"
 
 
+def test_patient_context(mocker, condition_bundle):
+    mock_get = mocker.patch(
+        "carl.modules.fhirclient.FhirClient.get",
+        return_value=MockResponse(data=condition_bundle),
+    )
+    copd = Coding(system="http://hl7.org/fhir/sid/icd-10-cm", code="J44.9")
+    diabetes = Coding(system="http://hl7.org/fhir/sid/icd-10-cm", code="E11.9")
+
+    context = PatientContext(PATIENT_ID)
+    assert patient_has(PATIENT_ID, "Condition", {copd}, context=context) == {copd}
+    assert patient_has(PATIENT_ID, "Condition", {diabetes}, context=context)
+    assert not patient_has(
+        PATIENT_ID, "Condition", {CNICS_COPD_coding}, context=context
+    )
+
+    # matching on (system, code) keys yields keys
+    keys = frozenset((copd.key, CNICS_COPD_coding.key))
+    assert patient_has(PATIENT_ID, "Condition", keys, context=context) == {copd.key}
+    matcher = ValueSetMatcher.from_codings(keys)
+    assert patient_has(PATIENT_ID, "Condition", matcher, context=context) == {copd.key}
+    assert patient_has_any(PATIENT_ID, "Condition", matcher, context=context)
+
+    # all lookups served from a single round trip
+    assert mock_get.call_count == 1
+    # only the elements classification reads
+    assert mock_get.call_args[1]["params"] == {
+        "subject": PATIENT_ID,
+        "_elements": "code,subject",
+    }
+
+
+def test_coding_key(mocker, valueset_bundle, empty_valueset_cache):
+    coding = Coding(system="http://snomed.info/sct", code="404684003")
+    assert coding.key == ("http://snomed.info/sct", "404684003")
+    assert coding.key is coding_key("http://snomed.info/sct", "404684003")
+    assert hash(coding) == hash(coding.key)
+
+    mocker.patch(
+        "carl.modules.fhirclient.FhirClient.get",
+        return_value=MockResponse(data=valueset_bundle),
+    )
+    vs_url = "http://cnics-cirg.washington.edu/fhir/ValueSet/CNICS-COPD-codings"
+    keys = valueset_keys(vs_url)
+    assert keys == {c.key for c in valueset_codings(vs_url)}
+    # expansions share the interned keys
+    assert next(k for k in keys if k == coding.key) is coding.key
+
+
+def test_valueset_matcher(mocker, valueset_bundle, empty_valueset_cache):
+    mocker.patch(
+        "carl.modules.fhirclient.FhirClient.get",
+        return_value=MockResponse(data=valueset_bundle),
+    )
+    vs_url = "http://cnics-cirg.washington.edu/fhir/ValueSet/CNICS-COPD-codings"
+    matcher = valueset_matcher(vs_url)
+    assert matcher is valueset_matcher(vs_url)
+    assert matcher.keys() == valueset_keys(vs_url)
+    assert len(matcher) == len(valueset_codings(vs_url))
+
+    assert matcher.matches("http://snomed.info/sct", "404684003")
+    assert ("http://snomed.info/sct", "404684003") in matcher
+    assert not matcher.matches("http://loinc.org", "404684003")
+    assert matcher.any_match(
+        [
+            {"system": "http://loinc.org", "code": "4548-4"},
+            {"system": "http://snomed.info/sct", "code": "404684003"},
+        ]
+    )
+    assert not matcher.any_match([{"system": "http://loinc.org", "code": "4548-4"}])
+
+
+def test_token_list_param():
+    codings = [
+        Coding(system="https://cnics.cirg.washington.edu/diagnosis-name", code="COPD"),
+        Coding(
+            system="https://cnics.cirg.washington.edu/diagnosis-name",
+            code="COPD, exacerbation",
+        ),
+    ]
+    value = token_list_param(codings)
+    assert value.endswith("diagnosis-name|COPD\\, exacerbation")
+    assert parse_token_list(value) == [(c.system, c.code) for c in codings]
+    assert parse_token_list("J44.9") == [(None, "J44.9")]
+
+
+def test_patient_has_token_filter(mocker, condition_bundle):
+    condition_bundle["entry"].pop()
+    mock_get = mocker.patch(
+        "carl.modules.fhirclient.FhirClient.get",
+        return_value=MockResponse(data=condition_bundle),
+    )
+    copd = Coding(system="http://hl7.org/fhir/sid/icd-10-cm", code="J44.9")
+    other = Coding(system="http://hl7.org/fhir/sid/icd-10-cm", code="J41.0")
+
+    found = patient_has(PATIENT_ID, "Condition", {copd, other}, filter_mode="tokens")
+    assert found == {copd}
+    assert mock_get.call_args[1]["params"] == {
+        "subject": PATIENT_ID,
+        "code": token_list_param([other, copd]),
+        "_elements": "code,subject",
+    }
+
+    patient_has(
+        PATIENT_ID,
+        "Condition",
+        {copd},
+        valueset_url="http://example.org/ValueSet/COPD",
+        filter_mode="valueset",
+    )
+    assert mock_get.call_args[1]["params"] == {
+        "subject": PATIENT_ID,
+        "code:in": "http://example.org/ValueSet/COPD",
+        "_elements": "code,subject",
+    }
+
+
+def test_patient_has_any_short_circuit(mocker, condition_bundle):
+    copd_entry, diabetes_entry = condition_bundle["entry"]
+    first_page = dict(condition_bundle, total=2, entry=[copd_entry])
+    first_page["link"] = [{"relation": "next", "url": "http://hapi/fhir/page2"}]
+    second_page = dict(condition_bundle, total=2, entry=[diabetes_entry])
+    mock_get = mocker.patch(
+        "carl.modules.fhirclient.FhirClient.get",
+        side_effect=[MockResponse(data=first_page), MockResponse(data=second_page)],
+    )
+    copd = Coding(system="http://hl7.org/fhir/sid/icd-10-cm", code="J44.9")
+    diabetes = Coding(system="http://hl7.org/fhir/sid/icd-10-cm", code="E11.9")
+    existence_stats.reset()
+
+    context = PatientContext(PATIENT_ID)
+    assert patient_has_any(PATIENT_ID, "Condition", {copd}, context=context)
+    assert mock_get.call_count == 1
+    stats = existence_stats.stats()
+    assert stats["existence_short_circuits"] == 1
+    assert stats["existence_pages_avoided"] == 1
+    assert stats["existence_bytes_avoided"] > 0
+
+    # later consumer resumes paging, without refetching the first page
+    assert patient_has(PATIENT_ID, "Condition", {diabetes}, context=context)
+    assert mock_get.call_count == 2
+    assert len(context.resources("Condition")) == 2
+
+
+def test_patient_has_any_count(mocker):
+    mock_get = mocker.patch(
+        "carl.modules.fhirclient.FhirClient.get",
+        return_value=MockResponse(data={"resourceType": "Bundle", "total": 0}),
+    )
+    copd = Coding(system="http://hl7.org/fhir/sid/icd-10-cm", code="J44.9")
+    assert not patient_has_any(PATIENT_ID, "Condition", {copd}, filter_mode="tokens")
+    assert mock_get.call_args[1]["params"]["_summary"] == "count"
+
+
+def test_query_plan(app_context, mocker, condition_bundle, empty_valueset_cache):
+    icd = "http://hl7.org/fhir/sid/icd-10-cm"
+    copd_url = "http://example.org/ValueSet/COPD"
+    diabetes_url = "http://example.org/ValueSet/diabetes"
+    for url, code in ((copd_url, "J44.9"), (diabetes_url, "E11.9")):
+        empty_valueset_cache.add(
+            {
+                "url": url,
+                "compose": {"include": [{"system": icd, "concept": [{"code": code}]}]},
+            }
+        )
+    groups = "https://example.org/groups"
+    copd = Rule(
+        marker=Coding(system=groups, code="copd"),
+        criteria=HasCoding("Condition", copd_url),
+    )
+    diabetes = Rule(
+        marker=Coding(system=groups, code="diabetes"),
+        criteria=AnyOf(
+            ValueAtLeast(A1C_observation_coding, 6.5),
+            HasCoding("Condition", diabetes_url),
+        ),
+    )
+    plan = QueryPlan((copd, diabetes), filter_mode="tokens")
+    assert plan.describe() == {
+        "Condition": {"sources": [copd_url, diabetes_url], "searches": 1},
+        "Observation": {
+            "sources": [A1C_observation_coding.value_param()],
+            "searches": 1,
+        },
+    }
+
+    empty_bundle = {"resourceType": "Bundle", "total": 0}
+    mock_get = mocker.patch(
+        "carl.modules.fhirclient.FhirClient.get",
+        side_effect=lambda resource_type, params: MockResponse(
+            data=condition_bundle if resource_type == "Condition" else empty_bundle
+        ),
+    )
+    criterion_stats.reset()
+    context = PatientContext(PATIENT_ID, writer=BatchWriter(dry_run=True))
+    results = classify(PATIENT_ID, (copd, diabetes), context, plan)
+    assert results["copd_matched"] and results["diabetes_matched"]
+    assert results["Hemoglobin A1C count"] == 0
+
+    # a single search per resource type, shared by both rules
+    assert mock_get.call_count == 2
+    condition_params = mock_get.call_args_list[0][1]["params"]
+    assert parse_token_list(condition_params["code"]) == [
+        (icd, "E11.9"),
+        (icd, "J44.9"),
+    ]
+
+    # each charged the round trips for the types it reads, whichever made them
+    round_trips = criterion_stats.stats()["criteria_round_trips"]
+    assert round_trips["COPD"] == round_trips["diabetes"] == 1
+    assert round_trips["Hemoglobin A1C >= 6.5"] == 1
+
+    # by membership in any of the ValueSets, given server side terminology
+    mock_get.reset_mock()
+    plan = QueryPlan((copd, diabetes), filter_mode="valueset")
+    context = PatientContext(PATIENT_ID, writer=BatchWriter(dry_run=True))
+    assert classify(PATIENT_ID, (copd, diabetes), context, plan)["copd_matched"]
+    assert mock_get.call_args_list[0][1]["params"]["code:in"] == (
+        f"{copd_url},{diabetes_url}"
+    )
+
+    # existence checks otherwise page only until a match is found
+    existence_stats.reset()
+    plan = QueryPlan((copd,), filter_mode="local")
+    context = PatientContext(PATIENT_ID, writer=BatchWriter(dry_run=True))
+    assert classify(PATIENT_ID, (copd,), context, plan)["copd_matched"]
+    assert existence_stats.stats()["existence_queries"] == 1
+
+
+def test_query_plan_local_labs(app_context, mocker, diabetes_intvalue_observation):
+    a1c = diabetes_intvalue_observation.as_fhir()
+    uncoded = {"resourceType": "Observation", "id": "uncoded"}
+    mock_get = mocker.patch(
+        "carl.modules.fhirclient.FhirClient.get",
+        return_value=MockResponse(
+            data={
+                "resourceType": "Bundle",
+                "entry": [{"resource": a1c}, {"resource": uncoded}],
+            }
+        ),
+    )
+    diabetes = Rule(
+        marker=Coding(system="https://example.org/groups", code="diabetes"),
+        criteria=ValueAtLeast(A1C_observation_coding, 6.5),
+    )
+    plan = QueryPlan((diabetes,), filter_mode="local")
+    context = PatientContext(PATIENT_ID, writer=BatchWriter(dry_run=True))
+    results = classify(PATIENT_ID, (diabetes,), context, plan)
+    assert results["diabetes_matched"]
+    assert results["Hemoglobin A1C count"] == 1
+
+    # lab codings are searched for, even when filtering locally
+    assert mock_get.call_count == 1
+    params = mock_get.call_args[1]["params"]
+    assert params["code"] == token_list_param([A1C_observation_coding])
+
+
+def test_criterion_stats_order():
+    stats = CriterionStats()
+    slow = HasCoding("Condition", "http://example.org/ValueSet/slow")
+    cheap = HasCoding("Condition", "http://example.org/ValueSet/cheap")
+    rare = HasCoding("Condition", "http://example.org/ValueSet/rare")
+    # declared order kept until each criterion is sampled
+    assert stats.ordered((slow, cheap)) == (slow, cheap)
+
+    for i in range(MIN_SAMPLES):
+        stats.record(slow.name, matched=i % 2, round_trips=3)
+        stats.record(cheap.name, matched=i % 2, round_trips=1)
+        stats.record(rare.name, matched=False, round_trips=1)
+    assert stats.ordered((slow, cheap)) == (cheap, slow)
+    # equally cheap, but more often matching, first
+    assert stats.ordered((rare, cheap)) == (cheap, rare)
+
+    summary = stats.stats()
+    assert summary["criteria_evaluated"]["slow"] == MIN_SAMPLES
+    assert summary["criteria_matched"]["slow"] == MIN_SAMPLES // 2
+    assert summary["criteria_round_trips"]["slow"] == MIN_SAMPLES * 3
+
+
+def test_subject_id():
+    def subject(reference):
+        return subject_id({"subject": {"reference": reference}})
+
+    assert subject("Patient/1") == "1"
+    assert subject("http://hapi/fhir/Patient/1") == "1"
+    assert subject("Patient/1/_history/2") == "1"
+    assert subject("http://hapi/fhir/Patient/1/_history/2") == "1"
+    assert subject("Group/1") is None
+    assert subject("Patient/") is None
+    assert subject_id({}) is None
+
+
+def test_prefetch_demultiplex(mocker, condition_bundle, diabetes_intvalue_observation):
+    mock_get = mocker.patch("carl.modules.fhirclient.FhirClient.get")
+    a1c = diabetes_intvalue_observation.as_fhir()
+    a1c["subject"] = {"reference": f"Patient/{PATIENT_ID}"}
+    page = {
+        "resourceType": "Bundle",
+        "entry": [
+            {
+                "resource": {"resourceType": "Patient", "id": PATIENT_ID},
+                "search": {"mode": "match"},
+            },
+            {
+                "resource": {"resourceType": "Patient", "id": "other"},
+                "search": {"mode": "match"},
+            },
+            {"resource": a1c, "search": {"mode": "include"}},
+        ]
+        + [
+            dict(search={"mode": "include"}, **entry)
+            for entry in condition_bundle["entry"]
+        ],
+    }
+
+    contexts = contexts_from_bundle(page, CLINICAL_REVINCLUDES)
+    assert [c.patient_id for c in contexts] == [PATIENT_ID, "other"]
+    context, other = contexts
+    assert context.loaded("MedicationRequest")
+    assert len(context.resources("Condition")) == 2
+    assert not other.resources("Condition")
+
+    labs = patient_observations(PATIENT_ID, A1C_observation_coding, context=context)
+    assert len(labs) == 1
+    assert labs[0].value_above_threshold("6.5")
+    assert not patient_observations("other", A1C_observation_coding, context=other)
+
+    # page's Observation values shared by its contexts
+    assert context.labs is other.labs
+    assert context.labs.at_least(A1C_observation_coding.key, 6.5) == {PATIENT_ID}
+
+    # everything answered from the demultiplexed page
+    assert mock_get.call_count == 0
+
+
+def test_observation_values(diabetes_pos_observation):
+    positive = diabetes_pos_observation.as_fhir()
+    negative = dict(positive, valueQuantity={"value": 4.95})
+    no_value = {"resourceType": "Observation", "code": positive["code"]}
+
+    labs = ObservationValues()
+    labs.extend("1", [positive])
+    labs.extend("2", [negative, no_value])
+    labs.extend("3", [])
+    assert len(labs) == 3
+    key = A1C_observation_coding.key
+    assert labs.at_least(key, 6.5) == {"1"}
+    assert labs.at_least(key, "4.9") == {"1", "2"}
+    assert labs.counts(key) == {"1": 1, "2": 2}
+    assert not labs.at_least(("http://loinc.org", "4548-4"), 0)
+
+    # added values invalidate prior results
+    labs.extend("3", [positive])
+    assert labs.at_least(key, 6.5) == {"1", "3"}
+
+
 def test_diabetes_obs_no_value(diabetes_observation):
     assert diabetes_observation.value_above_threshold("6.5") is None
 
@@ -272,3 +935,102 @@ def test_observation_serializers(diabetes_pos_observation):
     assert (
         obs.valuequantity.as_fhir() == diabetes_pos_observation.valuequantity.as_fhir()
     )
+
+
+def test_watermark_file(tmp_path):
+    path = str(tmp_path / "watermark.json")
+    assert load_watermark(path) is None
+    save_watermark(path, "2023-01-01T00:00:00+00:00")
+    save_watermark(path, "2023-02-01T00:00:00+00:00", site="uw")
+    assert load_watermark(path) == "2023-01-01T00:00:00+00:00"
+    assert load_watermark(path, site="uw") == "2023-02-01T00:00:00+00:00"
+
+
+def test_updated_subjects(mocker, copd_condition):
+    marker = copd_condition.as_fhir()
+    updated = {
+        "resourceType": "Condition",
+        "code": {"coding": [{"system": "http://snomed.info/sct", "code": "1"}]},
+        "subject": {"reference": "Patient/updated"},
+    }
+    bundles = {
+        "Condition": {
+            "resourceType": "Bundle",
+            "entry": [{"resource": marker}, {"resource": updated}],
+        }
+    }
+    mock_get = mocker.patch(
+        "carl.modules.fhirclient.FhirClient.get",
+        side_effect=lambda resource_type, params: MockResponse(
+            bundles.get(resource_type, {"resourceType": "Bundle"})
+        ),
+    )
+    since = "2023-01-01T00:00:00+00:00"
+    # marker Conditions written by classify itself are disregarded
+    assert updated_subjects(since, ignore_codings=[CNICS_COPD_coding]) == {"updated"}
+    assert mock_get.call_count == 3
+    assert mock_get.call_args[1]["params"]["_lastUpdated"] == f"gt{since}"
+
+
+def test_id_spool():
+    spool = IdSpool()
+    spool.extend(["a", "b"])
+    ids = iter(spool)
+    # readable while still being written
+    assert [next(ids), next(ids)] == ["a", "b"]
+    spool.extend(str(i) for i in range(10000))
+    spool.close()
+    assert len(list(ids)) == 10000
+    assert spool.count == 10002
+
+    failed = IdSpool()
+    failed.extend(["a"])
+    failed.close(ValueError("paging failed"))
+    with pytest.raises(ValueError):
+        list(failed)
+
+
+def test_spool_search_ids(app_context, mocker, patient_search_bundle):
+    # single page, sans next link
+    patient_search_bundle.pop("link")
+    mock_get = mocker.patch(
+        "carl.modules.fhirclient.FhirClient.get",
+        return_value=MockResponse(data=patient_search_bundle),
+    )
+    spool = spool_search_ids(app_context, "Patient", {"_count": 512})
+    assert list(spool) == [
+        entry["resource"]["id"] for entry in patient_search_bundle["entry"]
+    ]
+    assert mock_get.call_args[1]["params"]["_elements"] == "id"
+
+
+def test_checkpoint(tmp_path):
+    path = str(tmp_path / "checkpoint")
+    header = {"functions": ["classify_for_COPD"], "site": None}
+    checkpoint = Checkpoint(path, header)
+    checkpoint.done("1")
+    checkpoint.done("2")
+    # committed, and synced, only every so many patients or seconds
+    assert not checkpoint.due()
+    checkpoint._committed_at -= COMMIT_SECONDS
+    assert checkpoint.due()
+    checkpoint.commit()
+    assert not checkpoint.due()
+    checkpoint.done("3")
+    assert checkpoint.position == 3
+    # interrupted before committing 3, and while writing 4
+    checkpoint._file.write("4")
+    checkpoint._file.close()
+
+    resumed = Checkpoint(path, header, resume=True)
+    assert resumed.position == 2
+    assert list(resumed.skip(["1", "2", "3", "4"])) == ["3", "4"]
+    resumed.done("4")
+    resumed.close()
+    resumed = Checkpoint(path, header, resume=True)
+    assert resumed.completed == {"1", "2", "4"}
+    resumed.close(remove=True)
+
+    Checkpoint(path, header).close()
+    with pytest.raises(CheckpointMismatch):
+        Checkpoint(path, {"functions": [], "site": "uw"}, resume=True)